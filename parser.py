@@ -1,67 +1,78 @@
-"""Stuff to parse the output of running ps2ascii on the timetable PDF"""
+"""Stuff to parse the output of running ps2ascii on the timetable PDF.
+
+    python3 parser.py text.txt [ppc1-2013/tt.json]
+
+writes the parsed timetable as JSON, or as a snapshot (see
+ppc1-2013/snapshot.py) if the output file name ends in '.snap', and
+reports the parsing throughput on stderr.
+
+Parsing is a pipeline of generators: lines are read one at a time,
+parse_lines() turns each into a record as soon as it is read, and
+build_timetable() adds the records to a Timetable.  Each field at the end
+of an event line (groups, location, course manager) is found with a
+single end-anchored alternation of all of its possible forms, rather
+than by trying each form in turn.
+"""
+
+import os
+import re
+import sys
+import time
+import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'ppc1-2013'))
+from timetable import Timetable, Day, Event, DayOffEvent
+
+def _alternation(patterns):
+    """Compile a regex matching any of `patterns` at the end of a string.
+    Where more than one matches, the one starting earliest is used."""
+    return re.compile('(?:{})$'.format('|'.join(patterns)))
 
 class Parser:
-    
+
     week_regex = re.compile(r'^Commencing:(\d+)Week: (\d{2}-\w{3}-\d{2})$')
     day_off_regex = re.compile(r'^0 ')
     event_regex = re.compile(r'^\d{2}:\d{2}')
-    
+
     # Parsing:
     # - Parse groups, location and organiser from end of string
     # - Parse time and code from start of string
     # - What's left is the name
-    
-    tut_group_regexes = {
-            # This dict maps potential regexes for the core group
-            # listing to the number of characters that need to be shaved
-            # of the end after the core groups are extracts
-            
-            # Where values are lambdas and not ints, they are functions
-            # which take the *extracted* string and output the length to
-            # be shaved off.
-            re.compile(r'Core (\d{2}-\d{2})$'): 10,      # Core 01-02
-            re.compile(r'Core (\d{2}/\d{2})$'): 10,      # Core 01/02
-            re.compile(r'Core (\d{2}/\d{2}-\d{2})$'): 13,# Core 01/02-03
-            re.compile(r'Core (\d{2}-\d{2}/\d{2})$'): 13,# Core 01-02/03
-            re.compile(r'(Blue \w-\w) \((\d{1,2}-\d{1,2})\)$'):
-                lambda s: len(s) + 3,                  # Blue A-B (1-2)
-            re.compile(r'(Red \w-\w) \((\d{1,2}-\d{1,2})\)$'):
-                lambda s: len(s) + 3,                   # Red A-B (1-2)
-            re.compile(r'(ALL)$'): 3,
-            re.compile(r'(All)$'): 3,
-            re.compile(r'(n/a)$'): 3,
-            re.compile(r'(TBC)$'): 3
-        }
-    
-    involve_all_groups = {
-            'ALL',
-            'All',
-            'n/a',
-            'TBC'
-        }
-    
-    location_regexes = {
-            re.compile(r'(Lecture Theatre)$'): 15,
-            re.compile(r'(IT Study Room)$'): 13,
-            re.compile(r'(IT Ed Centre)$'): 12,
-            re.compile(r'(Blue Room)$'): 9,
-            re.compile(r'(Vanilla Cafe\')$'): 13,
-            re.compile(r'(Language Lab)$'): 12, #testing
-            re.compile(r'(Sem \d{2}-\d{2})$'): 9,
-            re.compile(r'(Sem \d-\d)$'): 7,
-            re.compile(r'(Sem \w-\w \(Gr Hall\))$'): 17,
-            re.compile(r'(n/a)$'): 3,
-            re.compile(r'(Atrium)$'): 6,
-            re.compile(r'(Presidents Hall)$'): 15,
-            re.compile(r'(Green Hall)$'): 10,
-            re.compile(r'(IT Rooms)$'): 8,
-            re.compile(r'(Kings Inns)$'): 10,
-            re.compile(r'(Red Cow Moran H)$'): 15
-        }
-    
-    time_regex = re.compile(r'^(\d{2}:\d{2})( - ?(\d{2}:\d{2}))?')
+
+    tut_group_regex = _alternation([
+            r'Core (?P<core>\d{2}/\d{2}-\d{2}'  # Core 01/02-03
+                r'|\d{2}-\d{2}/\d{2}'           # Core 01-02/03
+                r'|\d{2}-\d{2}'                 # Core 01-02
+                r'|\d{2}/\d{2})',               # Core 01/02
+            r'(?P<sem>(?:Blue|Red) \w-\w) '     # Blue A-B (1-2)
+                r'\((?P<sem_core>\d{1,2}-\d{1,2})\)',
+            r'(?P<all>ALL|All|n/a|TBC)'
+        ])
+
+    location_regex = _alternation([
+            r'Lecture Theatre',
+            r'IT Study Room',
+            r'IT Ed Centre',
+            r'Blue Room',
+            r'Vanilla Cafe\'',
+            r'Language Lab',
+            r'Sem \d{2}-\d{2}',
+            r'Sem \d-\d',
+            r'Sem \w-\w \(Gr Hall\)',
+            r'n/a',
+            r'Atrium',
+            r'Presidents Hall',
+            r'Green Hall',
+            r'IT Rooms',
+            r'Kings Inns',
+            r'Red Cow Moran H'
+        ])
+
+    time_regex = re.compile(r'^(\d{2}):(\d{2})(?: - ?(\d{2}):(\d{2}))?')
     first_event_date_regex = re.compile(r'(\w{3} \d{1,2} \w{3} \d{2})$')
-    
+    day_off_date_regex = re.compile(r'(\w{3} \d{1,2} \w{3} \d{2}) \S+$')
+
     course_managers = [
         'Gabriel Brennan',
         'Maura Butler',
@@ -82,63 +93,76 @@ class Parser:
         'Anne Walsh',
         'Colette Reid / Mau'
         ]
-        
+
+    course_manager_regex = _alternation(re.escape(m) for m in course_managers)
+
     def __init__(self):
+        self.all_tut_groups = list(range(1, 21))
         self.all_sem_groups = (self.parse_sem_groups('Red A-H')
                 + self.parse_sem_groups('Red K-R')
                 + self.parse_sem_groups('Blue A-H')
                 + self.parse_sem_groups('Blue K-R'))
+        self.lines = 0
 
-    def parse_file(self, f):
-        # TODO:  Sometimes new day happens without prior empty line.
-        # We need to detect new days by presence of date in line (and
-        # test this against date of previous day to make sure it's not
-        # just a page break).  I think this will also mean proper
-        # parsing of day off lines.
-        tt = Timetable()
-        new_day = True
-        day = None
-        for line in f:
-            try:
-                print('week defined as {}'.format(week))
-            except:
-                print('week not defined')
+    def parse_lines(self, lines):
+        """Generate a record for each line of `lines` which describes a
+        week, a day off or an event, as it is read.  Records are tuples:
+
+            ('week', num, commences)
+            ('day_off', date)
+            ('event', date, event)
+
+        where the date of an event is None unless the line gives it (as
+        the first line of each day does)."""
+        for line in lines:
+            self.lines += 1
             line = line.strip()
-            print(line)
-            #if not line:
-            #    new_day = True
-            match = re.match(self.week_regex, line)
+            match = self.week_regex.match(line)
             if match:
-                print('ADDING WEEK')
-                wnum = match.group(1)
                 t = time.strptime(match.group(2), '%d-%b-%y')
-                week = tt.new_week(int(match.group(1)), datetime.date(*t[:3]))
-                new_day = True
+                yield ('week', int(match.group(1)), datetime.date(*t[:3]))
                 continue
-            match = re.match(self.day_off_regex, line)
-            if match:
-                day = week.new_day()
-                print('added {} to {}'.format(day, week))
-                evt = day.new_event(off=True)
-                evt.day = day
-                #new_day = False
+            if self.day_off_regex.match(line):
+                match = self.day_off_date_regex.search(line)
+                yield ('day_off', self.parse_date(match.group(1)))
                 continue
-            match = re.match(self.event_regex, line)
-            if match:
-                print('declaring event in {}'.format(week))
-                event = Event(week)
-                self.parse_event_str(line, event)
-                #if day is None:
-                #    day = week.new_day()
-                #day.events.append(event)
-                print('event is in {}'.format(event.day))
-                #new_day = False
+            if self.event_regex.match(line):
+                event = Event()
+                date = self.parse_event_str(line, event)
+                yield ('event', date, event)
+
+    def build_timetable(self, records):
+        """Build a Timetable from the records generated by parse_lines.
+        An event with no date belongs to the same day as the previous
+        one."""
+        tt = Timetable()
+        week = day = None
+        for record in records:
+            kind = record[0]
+            if kind == 'week':
+                week = tt.new_week(record[1], record[2])
+                day = None
+            elif kind == 'day_off':
+                day = Day(week, date=record[1])
+                week.days.append(day)
+                evt = DayOffEvent(week, day)
+                day.events.append(evt)
+            else:
+                date, event = record[1:]
+                if date is not None and (day is None or date != day.date):
+                    day = Day(week, date=date)
+                    week.days.append(day)
+                event.week = week
+                event.day = day
+                day.events.append(event)
         return tt
-    
+
+    def parse_file(self, f):
+        return self.build_timetable(self.parse_lines(f))
+
     def parse_tut_groups(self, string):
         """Takes a string indicating a range or selection of core groups
         and returns the groups caught by the string"""
-        print('parse_groups called with {}'.format(string))
         numstack = []
         rangestack = []
         groups = []
@@ -147,130 +171,108 @@ class Parser:
         for c in string + '|':  # '|' indicates end of string; should
                                 # not appear anywhere else in string
             if c.isdigit():
-                #print('appending {} to numstack'.format(c))
                 numstack.append(c)
             elif c == '-':
                 in_range = True
-                #print('pushing {} to rangestack'.format(''.join(numstack)))
                 rangestack.append(int(''.join(numstack)))
                 numstack = []
             elif c in {'/', '|'}:
                 if in_range:
-                    #print('pushing {} to rangestack'.format(''.join(numstack)))
                     rangestack.append(int(''.join(numstack)))
                     numstack = []
                     in_range = False
                 else:
-                    print('adding {} to groups'.format(''.join(numstack)))
                     groups.append(int(''.join(numstack)))
                     numstack = []
-        
+
         if rangestack:
             start, end = rangestack
             groups.extend(range(start, end+1))
         if numstack:
             groups.append(int(''.join(numstack)))
         return groups
-    
+
     def parse_sem_groups(self, string):
         colour, letters = string.split(' ')
         start, end = letters.split('-')
         return ['{} {}'.format(colour, chr(i)) for i in range(ord(start), ord(end)+1)]
-            
-            
+
+    def parse_date(self, string):
+        t = time.strptime(string, '%a %d %b %y')
+        return datetime.date(*t[:3])
+
     def parse_event_str(self, string, event):
+        """Parse the event line `string` into `event`, and return the
+        date given in the line, if any."""
         string = string.strip()
-        #print(string)
-        # Find tutorial/seminar groups involved groups involved
-        for pattern in self.tut_group_regexes:
-            match = re.search(pattern, string)
-            if not match:
-                continue
-            try:
-                tut_group_str = match.group(2)
-                sem_group_str = match.group(1)
-            except IndexError:
-                sem_group_str = None
-                tut_group_str = match.group(1)
-            if tut_group_str in self.involve_all_groups:
-                event.tutorial_groups = list(range(1, 21))
-            else:
-                event.tutorial_groups = self.parse_tut_groups(tut_group_str)
-            if sem_group_str is None:
+        # Find tutorial/seminar groups involved
+        match = self.tut_group_regex.search(string)
+        if match is None:
+            event.tutorial_groups = self.all_tut_groups
+            event.seminar_groups = self.all_sem_groups
+        else:
+            if match.group('core'):
+                event.tutorial_groups = self.parse_tut_groups(match.group('core'))
                 event.seminar_groups = self.all_sem_groups
+            elif match.group('sem'):
+                event.tutorial_groups = self.parse_tut_groups(match.group('sem_core'))
+                event.seminar_groups = self.parse_sem_groups(match.group('sem'))
             else:
-                event.seminar_groups = self.parse_sem_groups(sem_group_str)
-            try:
-                string = string[:-self.tut_group_regexes[pattern]].strip()
-            except TypeError:
-                string = string[:-self.tut_group_regexes[pattern](''.join(match.groups()))].strip()
-            break
-        if event.tutorial_groups is EmptyValue:
-            event.tutorial_groups = list(range(1, 21))
-        if event.seminar_groups is EmptyValue:
-            event.seminar_groups = self.all_sem_groups
-        print(string)
-        
+                event.tutorial_groups = self.all_tut_groups
+                event.seminar_groups = self.all_sem_groups
+            string = string[:match.start()].strip()
+
         # First event of each day has the date stuck in the
         # middle of the string.  We use this to detect new days.
-        try:
-            prev_day = event.week.days[-1]
-        except IndexError:
-            prev_day = None
-        try:
-            prev_date = prev_day.date
-        except AttributeError:
-            prev_date = None
-        
-        datematch = re.search(self.first_event_date_regex, string)
-        if datematch:
-            print('datematch found')
-            # Either a new day, or a day is continuing after a page break
-            datestr = datematch.group(1)
-            print(datestr)
-            t = time.strptime(datestr, '%a %d %b %y')
-            date = datetime.date(*t[:3])
-            print(date)
-            print(prev_date)
-            print(event.week.days)
-            if date != prev_date:
-                event.day = event.week.new_day()
-            else:
-                event.day = prev_day
-            datelen = len(datestr)
-            string = string[:-datelen]
-        else:
-            event.day = prev_day
-        event.day.events.append(event)
-            
+        date = None
+        match = self.first_event_date_regex.search(string)
+        if match:
+            date = self.parse_date(match.group(1))
+            string = string[:match.start()]
+
         # Find location
-        for pattern in self.location_regexes:
-            match = re.search(pattern, string)
-            if not match:
-                continue
-            print('Matched {}'.format(pattern))
+        match = self.location_regex.search(string)
+        if match:
             event.location = match.group()
-            string = string[:-self.location_regexes[pattern]].strip()
-            break
+            string = string[:match.start()].strip()
         # Find course manager
-        for name in self.course_managers:
-            if string.endswith(name):
-                event.coordinator = name
-                string = string[:-len(name)]
-                break
+        match = self.course_manager_regex.search(string)
+        if match:
+            event.coordinator = match.group()
+            string = string[:match.start()]
         # Find start and end times
-        match = re.match(self.time_regex, string)
-        starts = match.group(1)
-        hours, mins = starts.split(':')
-        event.starts = datetime.time(int(hours), int(mins))
-        ends = match.group(3) or None
-        if ends is not None:
-            hours, mins = ends.split(':')
-            event.ends = datetime.time(int(hours), int(mins))
+        match = self.time_regex.match(string)
+        h1, m1, h2, m2 = match.groups()
+        event.starts = datetime.time(int(h1), int(m1))
+        if h2 is not None:
+            event.ends = datetime.time(int(h2), int(m2))
         else:
             event.ends = None
-        string = re.sub(self.time_regex, '', string).strip()
-        tokens = string.split(' ')
+        tokens = string[match.end():].strip().split(' ')
         # Find course code and event name
         event.code = tokens.pop(0)
         event.name = ' '.join(tokens)
+        return date
+
+def write_timetable(tt, fname):
+    """Write `tt` to `fname`, as a snapshot if the name ends in '.snap'
+    and as JSON otherwise.  Either is written atomically (see
+    timetable.write_file), as the app may be reading it."""
+    if fname.endswith('.snap'):
+        from snapshot import compile_snapshot
+        compile_snapshot(tt, fname)
+    else:
+        tt.save(fname)
+
+if __name__ == '__main__':
+    from sys import argv
+    in_fname = argv[1] if len(argv) > 1 else 'text.txt'
+    out_fname = argv[2] if len(argv) > 2 else os.path.join('ppc1-2013', 'tt.json')
+    parser = Parser()
+    start = time.perf_counter()
+    with open(in_fname) as f:
+        tt = parser.parse_file(f)
+    elapsed = time.perf_counter() - start
+    write_timetable(tt, out_fname)
+    sys.stderr.write('Parsed {} lines in {:.3f}s ({:,.0f} lines/sec)\n'.format(
+        parser.lines, elapsed, parser.lines / elapsed))
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+"""An asyncio (ASGI) entry point for the timetable app, as an alternative
+to running main.app under a synchronous WSGI server.  Run it with any
+ASGI server, eg:
+
+    uvicorn asgi:app
+    gunicorn -k uvicorn.workers.UvicornWorker asgi:app
+
+This needs Python 3.5 or later (for async/await) and an ASGI server,
+neither of which the WSGI app requires.
+
+Searches (GET /timetable with a canonical query string) are served by
+the event loop itself: 304s, materialised pages and cached pages are
+answered directly, and pages which must be rendered are rendered in a
+bounded pool of threads, so one slow render never blocks other requests.
+Identical searches arriving while a page is being rendered wait for that
+render rather than starting their own.  Once ASGI_MAX_PENDING distinct
+renders are queued or running, further searches needing a render get an
+immediate 503 rather than joining an ever-growing queue.
+
+Every other request is passed to the Flask app (main.app), run in a
+thread of its own bounded pool, and its response is sent as the app
+produces it, so streamed responses (eg, /api/events) stay streamed.
+Once ASGI_WSGI_MAX_PENDING such requests are queued or running, further
+ones also get an immediate 503.  Cache lookups and decompression of
+cached pages run in a third, small pool, so neither slow renders nor
+slow clients of the Flask app hold up searches for cached pages.
+"""
+
+import os
+import sys
+import gzip
+import asyncio
+import threading
+from io import BytesIO
+from urllib.parse import parse_qsl, urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.datastructures import MultiDict
+
+import main
+from timetable import SearchQuery
+
+# Number of threads rendering pages at once
+ASGI_RENDER_THREADS = int(os.environ.get('ASGI_RENDER_THREADS', 2))
+# Number of distinct renders which may be queued or running before
+# searches needing another are turned away with 503 Service Unavailable
+ASGI_MAX_PENDING = int(os.environ.get('ASGI_MAX_PENDING', 16))
+# Value of the Retry-After header sent with a 503, in seconds
+ASGI_RETRY_AFTER = 2
+# Number of chunks of a Flask response which may be waiting to be sent
+# before the thread producing them waits for the client
+WSGI_QUEUE_SIZE = 8
+# Number of threads running the Flask app at once, and number of requests
+# to it which may be queued or running before others are turned away
+ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', 8))
+ASGI_WSGI_MAX_PENDING = int(os.environ.get('ASGI_WSGI_MAX_PENDING', 32))
+# Number of threads looking up and decompressing cached pages
+ASGI_LOOKUP_THREADS = int(os.environ.get('ASGI_LOOKUP_THREADS', 2))
+
+_render_executor = ThreadPoolExecutor(ASGI_RENDER_THREADS)
+_wsgi_executor = ThreadPoolExecutor(ASGI_WSGI_THREADS)
+_lookup_executor = ThreadPoolExecutor(ASGI_LOOKUP_THREADS)
+# Number of requests to the Flask app queued or running
+_wsgi_pending = 0
+# Maps (timetable version, query cache key) -> Future of the page being
+# rendered for it
+_pending = {}
+
+def _headers(scope):
+    return {k.decode('latin-1').lower(): v.decode('latin-1')
+            for k, v in scope['headers']}
+
+def _accepts_gzip(headers):
+    """Return whether the Accept-Encoding header gives gzip (or failing
+    that, *) a quality above 0, as main._accepts_gzip does."""
+    qualities = {}
+    for coding in headers.get('accept-encoding', '').split(','):
+        name, _, params = coding.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name.strip().lower()] = quality
+    return qualities.get('gzip', qualities.get('*', 0)) > 0
+
+def _etag_matches(headers, etag):
+    tags = [t.strip() for t in headers.get('if-none-match', '').split(',')]
+    return '"{}"'.format(etag) in tags or '*' in tags
+
+async def _start(send, status, headers):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(k.encode('latin-1'), v.encode('latin-1'))
+                            for k, v in headers]})
+
+async def _send(send, status, headers, body=b''):
+    await _start(send, status, headers)
+    await send({'type': 'http.response.body', 'body': body})
+
+async def _busy(send):
+    await _send(send, 503, [('Retry-After', str(ASGI_RETRY_AFTER)),
+                            ('Content-Type', 'text/plain')],
+                b'The timetable is busy; please try again shortly.\n')
+
+async def _render(query, current):
+    """Return the page for `query`, rendered in the render pool, or None
+    if too many renders are already pending.  A render of the same page
+    already pending is shared rather than repeated."""
+    key = (current.version, query.cache_key())
+    future = _pending.get(key)
+    if future is None:
+        if len(_pending) >= ASGI_MAX_PENDING:
+            return None
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(_render_executor, main.render_page,
+                                        query, current)
+        _pending[key] = future
+        future.add_done_callback(lambda f: _pending.pop(key, None))
+    # Shielded, so a client disconnecting doesn't cancel the render for
+    # the others waiting on it.
+    return await asyncio.shield(future)
+
+def _search_terms(scope):
+    """Return the SearchQuery terms of a GET of /timetable, or None if the
+    request must be handled by the Flask app (eg, because it is not in
+    canonical form or has errors)."""
+    if scope['method'] not in ('GET', 'HEAD') or scope['path'] != '/timetable':
+        return None
+    query_string = scope['query_string'].decode('latin-1')
+    params = MultiDict(parse_qsl(query_string, keep_blank_values=True))
+    terms, error_msgs = main._parse_search(params)
+    if error_msgs:
+        return None
+    if query_string != urlencode(main._canonical_params(params, terms)):
+        return None
+    return terms
+
+async def _search(scope, send, terms):
+    current = main.data
+    main._normalise_terms(terms, current.all_codes)
+    query = SearchQuery(**terms)
+    headers = _headers(scope)
+    gzipped = _accepts_gzip(headers)
+    etag = main._etag(query.cache_key(), current, gzipped)
+    response_headers = [('ETag', '"{}"'.format(etag)),
+                        ('Vary', 'Accept-Encoding')]
+    if _etag_matches(headers, etag):
+        await _send(send, 304, response_headers)
+        return
+    loop = asyncio.get_event_loop()
+    page = await loop.run_in_executor(_lookup_executor, main.lookup_page,
+                                        query, current)
+    if page is None:
+        page = await _render(query, current)
+    if page is None:
+        await _busy(send)
+        return
+    if gzipped:
+        response_headers.append(('Content-Encoding', 'gzip'))
+    else:
+        # Pages can be several MB; keep the event loop free meanwhile
+        page = await loop.run_in_executor(_lookup_executor, gzip.decompress,
+                                            page)
+    response_headers.extend([('Content-Type', 'text/html; charset=utf-8'),
+                                ('Content-Length', str(len(page)))])
+    if scope['method'] == 'HEAD':
+        page = b''
+    await _send(send, 200, response_headers, page)
+
+def _wsgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'CONTENT_LENGTH': str(len(body))
+        }
+    for name, value in _headers(scope).items():
+        name = name.upper().replace('-', '_')
+        if name == 'CONTENT_TYPE':
+            environ[name] = value
+        elif name != 'CONTENT_LENGTH':
+            environ['HTTP_' + name] = value
+    return environ
+
+def _run_wsgi(environ, loop, queue, cancelled):
+    """Run the Flask app on `environ` (in a worker thread), putting its
+    status and headers, then each chunk of its body, and finally None on
+    the asyncio `queue`, stopping early if `cancelled` is set."""
+    def put(item):
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+    def start_response(status, headers, exc_info=None):
+        put((int(status.split(' ', 1)[0]), headers))
+    try:
+        result = main.app(environ, start_response)
+        try:
+            for chunk in result:
+                if cancelled.is_set():
+                    break
+                if chunk:
+                    put(chunk)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+    finally:
+        put(None)
+
+async def _drain(queue):
+    while (await queue.get()) is not None:
+        pass
+
+def _wsgi_done(future):
+    global _wsgi_pending
+    _wsgi_pending -= 1
+
+async def _wsgi(scope, receive, send):
+    global _wsgi_pending
+    if _wsgi_pending >= ASGI_WSGI_MAX_PENDING:
+        await _busy(send)
+        return
+    body = []
+    more = True
+    while more:
+        message = await receive()
+        body.append(message.get('body', b''))
+        more = message.get('more_body', False)
+    environ = _wsgi_environ(scope, b''.join(body))
+    loop = asyncio.get_event_loop()
+    queue = asyncio.Queue(WSGI_QUEUE_SIZE)
+    cancelled = threading.Event()
+    done = loop.run_in_executor(_wsgi_executor, _run_wsgi, environ, loop,
+                                queue, cancelled)
+    _wsgi_pending += 1
+    # Called in the loop's thread, as is everything else using the count
+    done.add_done_callback(_wsgi_done)
+    try:
+        item = await queue.get()
+        while item is not None:
+            if isinstance(item, tuple):
+                await _start(send, *item)
+            else:
+                await send({'type': 'http.response.body', 'body': item,
+                            'more_body': True})
+            item = await queue.get()
+    except BaseException:
+        # Eg, the client went away.  Let the app's thread finish.
+        cancelled.set()
+        loop.create_task(_drain(queue))
+        raise
+    # Raises any exception from the app (sent as a 500 by the server if
+    # the response has not been started)
+    await done
+    await send({'type': 'http.response.body', 'body': b''})
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            for executor in (_render_executor, _wsgi_executor,
+                                _lookup_executor):
+                executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    terms = _search_terms(scope)
+    if terms is None:
+        await _wsgi(scope, receive, send)
+    else:
+        await _search(scope, send, terms)
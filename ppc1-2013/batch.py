@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+"""Run a batch of searches against the timetable in one pass (see
+Timetable.filter_many), eg for reports covering every group.
+
+    python3 batch.py QUERIES [tt.json] [--events] [--processes=N]
+
+QUERIES is a file (or - for standard input) with one query per line, as
+a JSON object mapping SearchQuery term names to values encoded as in
+cache keys, eg:
+
+    {"tutorial_group": 3, "week_num": 12}
+    {"seminar_group": "Red B", "date": ["date", "2013-10-01"]}
+
+For each query, a line of JSON giving the query and the number of
+events it matches (and, with --events, the events) is printed.  With
+--processes, the queries are split between N worker processes (see
+parallel.py).
+"""
+
+import sys
+import json
+
+from timetable import Timetable, SearchQuery, entry_to_dict
+
+def read_queries(f):
+    """Return the query objects, and SearchQuery objects, on the
+    non-blank lines of the file `f`."""
+    terms = [json.loads(line) for line in f if line.strip()]
+    return terms, [SearchQuery.from_json_terms(d) for d in terms]
+
+def run_batch(tt, queries, with_events=False):
+    """Return a dict for each of `queries` giving the number of events in
+    `tt` (a Timetable, ColumnarStore or ParallelSearcher) it matches, and the events if
+    `with_events` is true."""
+    results = []
+    for result in tt.filter_many(queries):
+        entries = list(result.iter_entries())
+        d = {'count': len(entries)}
+        if with_events:
+            d['events'] = [entry_to_dict(*e) for e in entries]
+        results.append(d)
+    return results
+
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    with_events = '--events' in sys.argv
+    processes = 1
+    for a in sys.argv[1:]:
+        if a.startswith('--processes='):
+            processes = int(a.split('=', 1)[1])
+    queries_fname = args[0]
+    tt_fname = args[1] if len(args) > 1 else 'tt.json'
+    if queries_fname == '-':
+        terms, queries = read_queries(sys.stdin)
+    else:
+        with open(queries_fname) as f:
+            terms, queries = read_queries(f)
+    tt = Timetable(tt_fname)
+    if processes > 1:
+        from parallel import ParallelSearcher
+        with ParallelSearcher(tt, processes) as searcher:
+            results = run_batch(searcher, queries, with_events)
+    else:
+        results = run_batch(tt, queries, with_events)
+    for d, result in zip(terms, results):
+        result['query'] = d
+        print(json.dumps(result, sort_keys=True))
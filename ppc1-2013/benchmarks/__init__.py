@@ -0,0 +1,5 @@
+"""Benchmarks for the timetable data model and search pipeline.  Run
+each module from the ppc1-2013 directory, eg:
+
+    python3 -m benchmarks.memory
+"""
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+"""Compare Timetable.filter_many with a separate Timetable.filter call
+per query, for batches of report-style queries, on both the index and
+the columnar search backends.
+
+    python3 -m benchmarks.batch [tt.json]
+"""
+
+import time
+
+from timetable import SearchQuery, Timetable, all_tutorial_groups
+from columnar import ColumnarStore
+from materialise import group_queries
+
+def batches():
+    """Return (name, queries) for each batch of queries timed."""
+    return [
+        ('tutorial groups, week 12',
+            [SearchQuery(tutorial_group=g, week_num=12)
+                for g in all_tutorial_groups]),
+        ('tutorial groups, all weeks',
+            [SearchQuery(tutorial_group=g) for g in all_tutorial_groups]),
+        ('group pairs', group_queries())
+        ]
+
+def best_time(func, repeat=5):
+    """Return the shortest of `repeat` timings of func(), in seconds."""
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def run(fname='tt.json'):
+    tt = Timetable(fname)
+    searchers = [('index', tt), ('columnar', ColumnarStore(tt))]
+    results = []
+    for batch_name, queries in batches():
+        for searcher_name, searcher in searchers:
+            separate = best_time(lambda: [searcher.filter(q) for q in queries])
+            batched = best_time(lambda: searcher.filter_many(queries))
+            results.append({
+                'batch': batch_name,
+                'searcher': searcher_name,
+                'queries': len(queries),
+                'separate_secs': separate,
+                'batched_secs': batched,
+                'speedup': separate / batched
+                })
+    return results
+
+if __name__ == '__main__':
+    from sys import argv
+    print('{:<28} {:<9} {:>7} {:>11} {:>11} {:>8}'.format(
+        'Batch', 'Searcher', 'Queries', 'filter (ms)', 'many (ms)', 'Speedup'))
+    for r in run(*argv[1:2]):
+        print('{:<28} {:<9} {:>7} {:>11.1f} {:>11.1f} {:>7.1f}x'.format(
+            r['batch'], r['searcher'], r['queries'], r['separate_secs'] * 1000,
+            r['batched_secs'] * 1000, r['speedup']))
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+"""The original data model and SearchQuery.matches, before they were
+optimised, so that benchmarks can compare the two in one run: events
+are plain objects with a __dict__ whose groups are lists, every event
+has its own strings and times, there is no index, and a query evaluates
+every term for every event.
+"""
+
+import json
+import datetime
+
+from timetable import Any
+
+def _date(s):
+    return datetime.date(*(int(i) for i in s.split('/')))
+
+def _time(s):
+    if s is None:
+        return None
+    return datetime.time(*(int(i) for i in s.split(':')))
+
+class LegacyEvent:
+    """An event as originally loaded by Event.from_dict."""
+
+    def __init__(self, d, week, day):
+        self.starts = _time(d['starts'])
+        self.ends = _time(d['ends'])
+        self.tutorial_groups = d['tutorial_groups']
+        self.seminar_groups = d['seminar_groups']
+        self.coordinator = d['coordinator']
+        self.location = d['location']
+        self.code = d['code']
+        self.name = d['name']
+        self.day = day
+        self.week = week
+
+class LegacyDay:
+
+    def __init__(self, d, week):
+        self.week = week
+        self.date = _date(d['date'])
+        self.events = [LegacyEvent(e, week, self) for e in d['events']]
+
+class LegacyWeek:
+
+    def __init__(self, d):
+        self.num = d['num']
+        self.commences = _date(d['commences'])
+        self.days = [LegacyDay(dd, self) for dd in d['days']]
+
+class LegacyTimetable:
+    """A timetable loaded as the original Timetable(fname) did."""
+
+    def __init__(self, fname):
+        with open(fname) as f:
+            d = json.load(f)
+        self.weeks = [LegacyWeek(w) for w in d['weeks']]
+
+def _groups_match(group, evt_groups):
+    if evt_groups is None:
+        return False
+    elif group is Any:
+        return True
+    else:
+        return group in evt_groups
+
+def _matches_groups(sq, event):
+    return all([
+        _groups_match(sq.tutorial_group, event.tutorial_groups),
+        _groups_match(sq.seminar_group, event.seminar_groups)
+        ])
+
+def _matches_info(sq, event):
+    return all([
+        sq.starts == event.starts,
+        sq.ends == event.ends,
+        sq.coordinator == event.coordinator,
+        sq.location == event.location,
+        sq.name == event.name,
+        sq.code == event.code,
+        sq.date == event.day.date,
+        sq.day_of_week == event.day.date.weekday(),
+        sq.week_num == event.week.num,
+        sq.month == event.day.date.month,
+        event.day.date in sq.daterange,
+        (event.starts in sq.timerange) or (event.ends in sq.timerange)
+        ])
+
+def matches(sq, event):
+    """Return whether the LegacyEvent `event` matches the SearchQuery
+    `sq`, as the original SearchQuery.matches did."""
+    return _matches_groups(sq, event) and _matches_info(sq, event)
+
+def events(tt):
+    """Return a list of the events in the LegacyTimetable `tt`."""
+    return [e for w in tt.weeks for d in w.days for e in d.events]
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+"""A load generator for a running copy of the app, eg one started with
+
+    gunicorn -w 4 -b 127.0.0.1:8000 main:app
+
+which sends GETs of /timetable for a mix of searches like those made on
+the search form, from a number of concurrent clients, and reports the
+latency percentiles and throughput:
+
+    python3 -m benchmarks.loadgen [URL] [tt.json] [--requests=N]
+        [--concurrency=C] [--json=FILE]
+
+URL defaults to http://127.0.0.1:8000.  tt.json supplies the codes
+offered on the search form.  With --json, the results are also written
+to FILE (see benchmarks/report.py).
+"""
+
+import sys
+import time
+import threading
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError, URLError
+
+from timetable import Timetable
+from benchmarks.workload import form_queries, form_params, timetable_codes
+from benchmarks.report import summarise, write_json
+
+def search_urls(base_url, codes, n):
+    return ['{}/timetable?{}'.format(base_url.rstrip('/'),
+                                        urlencode(form_params(sq, codes)))
+            for sq in form_queries(codes, n)]
+
+def _fetch(url):
+    """GET `url`, and return its status code (or None if no response
+    was received)."""
+    request = Request(url, headers={'Accept-Encoding': 'gzip'})
+    try:
+        with urlopen(request) as response:
+            response.read()
+            return response.status
+    except HTTPError as e:
+        return e.code
+    except URLError:
+        return None
+
+def run(base_url='http://127.0.0.1:8000', fname='tt.json', requests=1000,
+        concurrency=8):
+    """Send `requests` searches to the app at `base_url` from
+    `concurrency` threads, and return the latency summary (see
+    report.summarise), requests per second and count of each status."""
+    codes = timetable_codes(Timetable(fname))
+    urls = search_urls(base_url, codes, requests)
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    next_url = iter(urls)
+    def client():
+        while True:
+            with lock:
+                url = next(next_url, None)
+            if url is None:
+                return
+            start = time.perf_counter()
+            status = _fetch(url)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+    threads = [threading.Thread(target=client) for i in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    results = summarise(latencies)
+    results.update({
+        'url': base_url,
+        'concurrency': concurrency,
+        'secs': elapsed,
+        'requests_per_sec': len(latencies) / elapsed,
+        'statuses': statuses
+        })
+    return results
+
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    options = {}
+    json_fname = None
+    for a in sys.argv[1:]:
+        if a.startswith('--requests='):
+            options['requests'] = int(a.split('=', 1)[1])
+        elif a.startswith('--concurrency='):
+            options['concurrency'] = int(a.split('=', 1)[1])
+        elif a.startswith('--json='):
+            json_fname = a.split('=', 1)[1]
+    r = run(*args[:2], **options)
+    print('{} requests from {} clients in {:.2f} secs: {:.1f} req/sec'.format(
+        r['count'], r['concurrency'], r['secs'], r['requests_per_sec']))
+    print('Latency (ms): p50 {:.1f}  p95 {:.1f}  p99 {:.1f}  max {:.1f}'.format(
+        r['p50_ms'], r['p95_ms'], r['p99_ms'], r['max_ms']))
+    print('Statuses: {}'.format(', '.join('{}: {}'.format(s, n)
+                                            for s, n in sorted(r['statuses'].items()))))
+    if json_fname is not None:
+        write_json(json_fname, 'loadgen', r)
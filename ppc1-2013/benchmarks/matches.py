@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+"""Compare the throughput of SearchQuery.matches (compiled checks, over
+events with group bitmasks) with the original matches (every term
+evaluated with all([...]), over events with lists of groups; see
+benchmarks/legacy.py) over the real timetable, for each combination of
+fields on the search form.
+
+    python3 -m benchmarks.matches [tt.json]
+"""
+
+import time
+
+from timetable import Timetable
+from benchmarks.workload import form_queries, timetable_codes
+from benchmarks import legacy
+
+def throughput(method, queries, events):
+    """Return the number of (query, event) matches evaluated per second
+    by calling `method(query, event)`."""
+    start = time.perf_counter()
+    for q in queries:
+        for e in events:
+            method(q, e)
+    elapsed = time.perf_counter() - start
+    return len(queries) * len(events) / elapsed
+
+def run(fname='tt.json'):
+    tt = Timetable(fname)
+    events = [e for e, w, d in tt.index.entries]
+    queries = form_queries(timetable_codes(tt))
+    legacy_events = legacy.events(legacy.LegacyTimetable(fname))
+    original = throughput(legacy.matches, queries, legacy_events)
+    compiled = throughput(lambda q, e: q.matches(e), queries, events)
+    return {
+        'queries': len(queries),
+        'events': len(events),
+        'original_per_sec': original,
+        'compiled_per_sec': compiled,
+        'speedup': compiled / original
+        }
+
+if __name__ == '__main__':
+    from sys import argv
+    results = run(*argv[1:2])
+    print('{} queries x {} events'.format(results['queries'], results['events']))
+    print('Original:        {:>12,.0f} matches/sec'.format(results['original_per_sec']))
+    print('Compiled:        {:>12,.0f} matches/sec'.format(results['compiled_per_sec']))
+    print('Speedup:         {:>12.1f}x'.format(results['speedup']))
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+"""Measure the memory taken by a loaded Timetable (including its index),
+using tracemalloc, and report it in bytes per event, before and after
+the changes to the data model: "before" is the original model, rebuilt
+in benchmarks/legacy.py, in which events are plain objects with a
+__dict__, groups are lists, every event has its own strings and times,
+and there is no index.
+
+    python3 -m benchmarks.memory [tt.json]
+"""
+
+import gc
+import json
+import tracemalloc
+
+from timetable import Timetable
+from benchmarks.legacy import LegacyTimetable
+
+def measure(load):
+    """Return (bytes allocated, object) for the object returned by
+    calling `load`, not counting anything freed before it returns."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        obj = load()
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return after - before, obj
+
+def count_events(tt):
+    return sum(len(d.events) for w in tt.weeks for d in w.days)
+
+def run(fname='tt.json'):
+    results = {}
+    size, raw = measure(lambda: json.load(open(fname)))
+    del raw
+    results['json'] = size
+    size, tt = measure(lambda: LegacyTimetable(fname))
+    results['legacy'] = size
+    results['legacy_per_event'] = size / count_events(tt)
+    del tt
+    size, tt = measure(lambda: Timetable(fname))
+    results['timetable'] = size
+    results['events'] = count_events(tt)
+    results['timetable_per_event'] = size / results['events']
+    return results
+
+if __name__ == '__main__':
+    from sys import argv
+    results = run(*argv[1:2])
+    print('Decoded JSON:      {:>10,} bytes'.format(results['json']))
+    print('Events:            {:>10,}'.format(results['events']))
+    print('Before (original model):')
+    print('  Timetable:       {:>10,} bytes'.format(results['legacy']))
+    print('  Bytes per event: {:>10,.0f}'.format(results['legacy_per_event']))
+    print('After (current model):')
+    print('  Timetable:       {:>10,} bytes'.format(results['timetable']))
+    print('  Bytes per event: {:>10,.0f}'.format(results['timetable_per_event']))
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+"""Measure how the throughput of rendering every tutorial group /
+seminar group pair's timetable scales with the number of worker
+processes (see parallel.py).
+
+    python3 -m benchmarks.parallel [tt.json [max processes]]
+"""
+
+import time
+import multiprocessing
+
+from timetable import Timetable
+from parallel import ParallelSearcher
+from materialise import group_queries
+
+def _render(tt, query):
+    return len(tt.filter(query).to_html())
+
+def run(fname='tt.json', max_processes=None):
+    tt = Timetable(fname)
+    queries = group_queries()
+    max_processes = int(max_processes or multiprocessing.cpu_count())
+    start = time.perf_counter()
+    for q in queries:
+        _render(tt, q)
+    serial = time.perf_counter() - start
+    results = [{'processes': 0, 'secs': serial,
+                'pages_per_sec': len(queries) / serial, 'speedup': 1.0}]
+    for n in range(1, max_processes + 1):
+        with ParallelSearcher(tt, n) as searcher:
+            start = time.perf_counter()
+            searcher.map(_render, queries)
+            elapsed = time.perf_counter() - start
+        results.append({'processes': n, 'secs': elapsed,
+                        'pages_per_sec': len(queries) / elapsed,
+                        'speedup': serial / elapsed})
+    return results
+
+if __name__ == '__main__':
+    from sys import argv
+    print('{:>9} {:>8} {:>10} {:>8}'.format('Processes', 'Secs', 'Pages/sec',
+                                            'Speedup'))
+    for r in run(*argv[1:3]):
+        print('{:>9} {:>8.2f} {:>10.1f} {:>7.2f}x'.format(
+            r['processes'] or 'serial', r['secs'], r['pages_per_sec'],
+            r['speedup']))
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+"""Time each stage of the search pipeline over the real timetable and a
+mix of queries like those made on the search form: loading the timetable
+(Timetable.__init__, and Timetable.from_dict of already-decoded JSON),
+SearchQuery.matches, Timetable.filter, Timetable.to_html, and the whole
+of handle_search through Flask's test client, both with the search cache
+empty and with the page cached.
+
+    python3 -m benchmarks.pipeline [tt.json] [--queries=N] [--json=FILE]
+
+The results are printed, and with --json also written to FILE (see
+benchmarks/report.py) so that runs can be compared over time.  The
+handle_search timings use the app's own configuration, and so the
+timetable in TT_JSON_FILE.
+"""
+
+import os
+import sys
+import json
+import time
+from urllib.parse import urlencode
+
+from timetable import Timetable
+from benchmarks.workload import form_queries, form_params, timetable_codes
+from benchmarks.report import summarise, write_json
+
+def _timings(func, args, repeat=1):
+    """Return the time taken by func(arg), in seconds, for each of
+    `args` (each repeated `repeat` times)."""
+    times = []
+    for i in range(repeat):
+        for arg in args:
+            start = time.perf_counter()
+            func(arg)
+            times.append(time.perf_counter() - start)
+    return times
+
+def _load_timings(fname, repeat):
+    with open(fname) as f:
+        d = json.load(f)
+    return {
+        'Timetable.__init__': _timings(Timetable, [fname] * repeat),
+        'Timetable.from_dict': _timings(lambda d: Timetable().from_dict(d),
+                                        [d] * repeat)
+        }
+
+def _matches_timings(tt, queries):
+    """Time SearchQuery.matches over every event, per query; the summary
+    is of the time per call."""
+    events = [e for e, w, d in tt.index.entries]
+    def match_all(sq):
+        for e in events:
+            sq.matches(e)
+    return [t / len(events) for t in _timings(match_all, queries)]
+
+def _search_timings(queries, codes):
+    # Not checking for changes to tt.json while the benchmark runs
+    os.environ.setdefault('TT_RELOAD_INTERVAL', '0')
+    import main
+    client = main.app.test_client()
+    urls = ['/timetable?' + urlencode(form_params(sq, codes))
+            for sq in queries]
+    headers = {'Accept-Encoding': 'gzip'}
+    def get(url):
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200, (url, response.status_code)
+        response.get_data()
+    def get_uncached(url):
+        main.search_cache.clear()
+        get(url)
+    uncached = _timings(get_uncached, urls)
+    for url in urls:
+        get(url)
+    cached = _timings(get, urls)
+    return {'handle_search (uncached)': uncached,
+            'handle_search (cached)': cached}
+
+def run(fname='tt.json', n=200, repeat=5):
+    """Return a summary (see report.summarise) of the timings of each
+    stage of the pipeline, for `n` queries."""
+    timings = _load_timings(fname, repeat)
+    tt = Timetable(fname)
+    codes = timetable_codes(tt)
+    queries = form_queries(codes, n)
+    timings['SearchQuery.matches'] = _matches_timings(tt, queries)
+    timings['Timetable.filter'] = _timings(tt.filter, queries)
+    results = [tt.filter(sq) for sq in queries]
+    timings['Timetable.to_html'] = _timings(lambda t: t.to_html(), results)
+    timings.update(_search_timings(queries, codes))
+    return {stage: summarise(times) for stage, times in timings.items()}
+
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    n = 200
+    json_fname = None
+    for a in sys.argv[1:]:
+        if a.startswith('--queries='):
+            n = int(a.split('=', 1)[1])
+        elif a.startswith('--json='):
+            json_fname = a.split('=', 1)[1]
+    results = run(*args[:1], n=n)
+    print('{:<26} {:>6} {:>10} {:>10} {:>10} {:>10}'.format(
+        'Stage', 'Count', 'Mean (ms)', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)'))
+    for stage in sorted(results):
+        r = results[stage]
+        print('{:<26} {:>6} {:>10.4f} {:>10.4f} {:>10.4f} {:>10.4f}'.format(
+            stage, r['count'], r['mean_ms'], r['p50_ms'], r['p95_ms'],
+            r['p99_ms']))
+    if json_fname is not None:
+        write_json(json_fname, 'pipeline', results)
@@ -0,0 +1,56 @@
+"""Summarising timings and saving benchmark results, so that runs can be
+compared over time."""
+
+import sys
+import json
+import time
+import platform
+import subprocess
+
+def percentile(samples, p):
+    """Return the `p`th percentile (0-100) of the sorted list `samples`,
+    by the nearest-rank method."""
+    if not samples:
+        return None
+    rank = max(1, -(-len(samples) * p // 100))
+    return samples[int(rank) - 1]
+
+def summarise(samples):
+    """Return the count, mean and percentiles of a list of timings in
+    seconds, with the times in milliseconds."""
+    samples = sorted(samples)
+    ms = lambda secs: None if secs is None else secs * 1000
+    return {
+        'count': len(samples),
+        'mean_ms': ms(sum(samples) / len(samples)) if samples else None,
+        'p50_ms': ms(percentile(samples, 50)),
+        'p95_ms': ms(percentile(samples, 95)),
+        'p99_ms': ms(percentile(samples, 99)),
+        'max_ms': ms(samples[-1]) if samples else None
+        }
+
+def _commit():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                        stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode('ascii').strip()
+
+def write_json(fname, benchmark, results):
+    """Write `results` to the file `fname` ('-' for standard output) as
+    JSON, with the time, Python version and git commit of the run."""
+    record = {
+        'benchmark': benchmark,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'commit': _commit(),
+        'results': results
+        }
+    if fname == '-':
+        json.dump(record, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(fname, 'w') as f:
+            json.dump(record, f, indent=2, sort_keys=True)
+            f.write('\n')
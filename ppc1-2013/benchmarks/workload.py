@@ -0,0 +1,103 @@
+"""Search queries resembling those produced by handle_search in main.py,
+for use by the benchmarks."""
+
+import random
+import datetime
+import itertools
+
+from timetable import (SearchQuery, MultiSearchTerm, TimeRange, Any,
+                        all_tutorial_groups, all_seminar_groups)
+
+FIRST_DAY = datetime.date(2013, 9, 10)
+LAST_DAY = datetime.date(2014, 4, 4)
+
+def _dates(rng):
+    """The date terms the search form can produce."""
+    day = FIRST_DAY + datetime.timedelta(rng.randrange(200))
+    return [
+        {},
+        {'date': day},
+        {'daterange': TimeRange(day, day + datetime.timedelta(6))},
+        {'daterange': TimeRange(FIRST_DAY, LAST_DAY)}
+        ]
+
+def _times():
+    return [
+        {},
+        {'timerange': TimeRange(datetime.time(9), datetime.time(13))},
+        {'timerange': TimeRange(datetime.time(14), datetime.time(17))}
+        ]
+
+def _codes(codes):
+    return [
+        {},
+        {'code': MultiSearchTerm(*codes[:len(codes) // 2])},
+        {'code': MultiSearchTerm(*codes[:3])}
+        ]
+
+def _weekdays():
+    return [
+        {},
+        {'day_of_week': MultiSearchTerm(0, 1, 2, 3, 4)},
+        {'day_of_week': MultiSearchTerm(2)}
+        ]
+
+def form_queries(codes, n=None, seed=0):
+    """Return a list of SearchQuery objects covering the combinations of
+    fields on the search form.  `codes` is the list of codes offered on
+    the form.  If `n` is given, return that many queries, chosen at
+    random (with repeats) from the combinations."""
+    rng = random.Random(seed)
+    combos = list(itertools.product(_dates(rng), _times(), _codes(codes),
+                                    _weekdays()))
+    if n is not None:
+        combos = [rng.choice(combos) for i in range(n)]
+    queries = []
+    for parts in combos:
+        terms = {
+            'tutorial_group': rng.choice(all_tutorial_groups),
+            'seminar_group': rng.choice(all_seminar_groups)
+            }
+        for p in parts:
+            terms.update(p)
+        queries.append(SearchQuery(**terms))
+    return queries
+
+def timetable_codes(tt):
+    return sorted(c for c in tt.index.values('code') if c is not None)
+
+def form_params(sq, codes):
+    """Return the search form fields which search for `sq` (a query from
+    form_queries or materialise.group_queries), as the sorted list of
+    (field, value) pairs of its canonical URL (see _canonical_params in
+    main.py).  `codes` is the list of codes offered on the form."""
+    pairs = [('tutorial_group', sq.tutorial_group),
+                ('seminar_group', sq.seminar_group)]
+    pairs.extend(('code', c) for c in (codes if sq.code is Any else sq.code))
+    pairs.extend(('weekday', d) for d in (range(7) if sq.day_of_week is Any
+                                            else sq.day_of_week))
+    if sq.date is not Any:
+        pairs.extend([('date', 'single'), ('date_year', sq.date.year),
+                        ('date_month', sq.date.month),
+                        ('date_day', sq.date.day)])
+    elif sq.daterange is not Any:
+        start, end = sq.daterange
+        pairs.extend([('date', 'range'),
+                        ('date_start_year', start.year),
+                        ('date_start_month', start.month),
+                        ('date_start_day', start.day),
+                        ('date_end_year', end.year),
+                        ('date_end_month', end.month),
+                        ('date_end_day', end.day)])
+    else:
+        pairs.append(('date', 'all'))
+    if sq.timerange is not Any:
+        start, end = sq.timerange
+        pairs.extend([('time', 'range'),
+                        ('time_start_hour', start.hour),
+                        ('time_start_min', start.minute),
+                        ('time_end_hour', end.hour),
+                        ('time_end_min', end.minute)])
+    else:
+        pairs.append(('time', 'all'))
+    return sorted((field, str(value)) for field, value in pairs)
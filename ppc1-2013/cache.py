@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+
+"""Caches for storing the rendered results of searches."""
+
+import os
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+def versioned_key(version, query):
+    """Return the key under which the page for `query` (a SearchQuery)
+    in the version `version` of the timetable (see Timetable.digest) is
+    cached.  Pages of different versions have different keys, so a
+    worker which has not yet reloaded a changed timetable can neither
+    serve nor overwrite the pages of the new version, in a cache shared
+    between workers, and vice versa."""
+    return '{}:{}'.format(version, query.cache_key())
+
+def split_key(key):
+    """Return the (version, query cache key) of a key made by
+    versioned_key."""
+    version, _, query_key = key.partition(':')
+    return version, query_key
+
+def _size(value):
+    """Return the size of `value` (a str or bytes) in bytes."""
+    if isinstance(value, bytes):
+        return len(value)
+    return len(value.encode('utf-8'))
+
+class LRUCache:
+    """A dict-like cache whose total size is capped at `max_bytes` bytes
+    of stored values.  When a new value would take the cache over that
+    size, the least recently used entries are evicted to make room.  If
+    `ttl` is given, entries older than `ttl` seconds are treated as
+    missing.
+
+    Counts of hits, misses, evictions and expirations are kept so that
+    the cache's behaviour can be observed (see stats())."""
+
+    def __init__(self, max_bytes, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # Maps key -> (value, size in bytes, time stored)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._lookup(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        size = _size(value)
+        with self._lock:
+            self._remove(key)
+            if size > self.max_bytes:
+                # Would evict everything else and still not fit.
+                return
+            while self.size + size > self.max_bytes:
+                _, entry = self._entries.popitem(last=False)
+                self.size -= entry[1]
+                self.evictions += 1
+            self._entries[key] = (value, size, time.time())
+            self.size += size
+
+    def __delitem__(self, key):
+        with self._lock:
+            if not self._remove(key):
+                raise KeyError(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self.size -= entry[1]
+        return True
+
+    def _lookup(self, key):
+        """Return the entry for `key` without touching the counters,
+        dropping it if it has expired."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if self.ttl is not None and time.time() - entry[2] > self.ttl:
+            self._remove(key)
+            self.expirations += 1
+            return None
+        return entry
+
+    def peek(self, key):
+        """Return the value of `key`, or None if it is not cached,
+        without counting a hit or miss or marking it as used."""
+        with self._lock:
+            entry = self._lookup(key)
+        return entry[0] if entry is not None else None
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def would_fit(self, value):
+        """Return whether `value` could be added without evicting any
+        existing entry."""
+        return self.size + _size(value) <= self.max_bytes
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries)
+
+    def copy(self, key, new_key):
+        """Store the value of `key`, if it is cached, under `new_key` as
+        well."""
+        with self._lock:
+            entry = self._lookup(key)
+        if entry is not None:
+            self[new_key] = entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def invalidate(self, predicate):
+        """Remove the entries whose keys satisfy `predicate`, and return
+        the number removed."""
+        with self._lock:
+            keys = [k for k in self._entries if predicate(k)]
+            for k in keys:
+                self._remove(k)
+        return len(keys)
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+            }
+
+class SQLiteCache:
+    """A cache with the same interface as LRUCache, but kept in an SQLite
+    database at `path` so that it is shared by every worker process on
+    the machine.  Keys must be strings which mean the same in every
+    process (see versioned_key).
+
+    The counters returned by stats() are those of the current process
+    only.  Errors from SQLite (eg, the database being locked for too
+    long by another worker) are counted and not raised: lookups miss,
+    stores and deletions are skipped, and sizes are reported as None (or
+    0 entries)."""
+
+    schema = """CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    stored REAL NOT NULL,
+                    used REAL NOT NULL
+                    )"""
+
+    def __init__(self, path, max_bytes, ttl=None, timeout=5.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.timeout = timeout
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.errors = 0
+
+    @property
+    def _conn(self):
+        """A connection for the current thread and process.  Connections
+        are not shared across fork() or between threads."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                    isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(self.schema)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def __len__(self):
+        try:
+            return self._conn.execute('SELECT COUNT(*) FROM entries'
+                                        ).fetchone()[0]
+        except sqlite3.Error:
+            self.errors += 1
+            return 0
+
+    def __contains__(self, key):
+        try:
+            return self._lookup(key) is not None
+        except sqlite3.Error:
+            self.errors += 1
+            return False
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        size = _size(value)
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        try:
+            conn = self._conn
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('INSERT OR REPLACE INTO entries VALUES '
+                                '(?, ?, ?, ?, ?)',
+                                (key, value, size, now, now))
+                self._evict(conn)
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+        except sqlite3.Error:
+            self.errors += 1
+
+    def __delitem__(self, key):
+        try:
+            cur = self._conn.execute('DELETE FROM entries WHERE key = ?',
+                                        (key,))
+        except sqlite3.Error:
+            self.errors += 1
+            return
+        if not cur.rowcount:
+            raise KeyError(key)
+
+    def _evict(self, conn):
+        """Delete least recently used entries until the total size is
+        within max_bytes."""
+        total = conn.execute('SELECT TOTAL(size) FROM entries').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in conn.execute('SELECT key, size FROM entries '
+                                        'ORDER BY used').fetchall():
+            conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+            self.evictions += 1
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def _lookup(self, key):
+        row = self._conn.execute('SELECT value, stored FROM entries '
+                                    'WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        if self.ttl is not None and time.time() - row[1] > self.ttl:
+            self._conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+            self.expirations += 1
+            return None
+        return row
+
+    def peek(self, key):
+        """Return the value of `key`, or None if it is not cached,
+        without counting a hit or miss or marking it as used."""
+        try:
+            row = self._lookup(key)
+        except sqlite3.Error:
+            self.errors += 1
+            return None
+        return row[0] if row is not None else None
+
+    def get(self, key, default=None):
+        try:
+            row = self._lookup(key)
+            if row is not None:
+                self._conn.execute('UPDATE entries SET used = ? '
+                                    'WHERE key = ?', (time.time(), key))
+        except sqlite3.Error:
+            self.errors += 1
+            row = None
+        if row is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return row[0]
+
+    def would_fit(self, value):
+        try:
+            total = self._conn.execute('SELECT TOTAL(size) FROM entries'
+                                        ).fetchone()[0]
+        except sqlite3.Error:
+            self.errors += 1
+            return False
+        return total + _size(value) <= self.max_bytes
+
+    def keys(self):
+        try:
+            return [row[0] for row in
+                    self._conn.execute('SELECT key FROM entries')]
+        except sqlite3.Error:
+            self.errors += 1
+            return []
+
+    def copy(self, key, new_key):
+        """Store the value of `key`, if it is cached, under `new_key` as
+        well."""
+        try:
+            conn = self._conn
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('INSERT OR REPLACE INTO entries '
+                                'SELECT ?, value, size, stored, used '
+                                'FROM entries WHERE key = ?', (new_key, key))
+                self._evict(conn)
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+        except sqlite3.Error:
+            self.errors += 1
+
+    def clear(self):
+        try:
+            self._conn.execute('DELETE FROM entries')
+        except sqlite3.Error:
+            self.errors += 1
+
+    def invalidate(self, predicate):
+        """Remove the entries whose keys satisfy `predicate`, and return
+        the number removed."""
+        try:
+            conn = self._conn
+            keys = [row[0] for row in conn.execute('SELECT key FROM entries')]
+            removed = [(k,) for k in keys if predicate(k)]
+            conn.executemany('DELETE FROM entries WHERE key = ?', removed)
+        except sqlite3.Error:
+            self.errors += 1
+            return 0
+        return len(removed)
+
+    def stats(self):
+        try:
+            entries, size = self._conn.execute('SELECT COUNT(*), TOTAL(size) '
+                                                'FROM entries').fetchone()
+            size = int(size)
+        except sqlite3.Error:
+            self.errors += 1
+            entries = size = None
+        return {
+            'entries': entries,
+            'bytes': size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'errors': self.errors
+            }
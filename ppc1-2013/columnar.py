@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+"""A column-oriented ("struct of arrays") store of the events in a
+Timetable.  Each event attribute is held in its own array, with text
+attributes dictionary-encoded as ints, so that a SearchQuery can be
+evaluated against every event at once as a single boolean mask.
+
+NumPy is used for the arrays if it is installed; otherwise the same
+columns are held in array.array objects and evaluated in pure Python.
+"""
+
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from timetable import (Timetable, MultiSearchTerm, TimeRange,
+                        Any, tutorial_group_registry, seminar_group_registry)
+
+# Stored in place of a missing time, date or group mask.
+MISSING = -1
+
+def _minutes(t):
+    return MISSING if t is None else t.hour * 60 + t.minute
+
+def _term_values(term):
+    """Return the values matched by the search term `term`, or None if it
+    matches any value."""
+    if term is Any:
+        return None
+    elif isinstance(term, MultiSearchTerm):
+        return list(term)
+    else:
+        return [term]
+
+if numpy is not None:
+
+    def _column(values):
+        return numpy.array(values, dtype=numpy.int64)
+
+    def _all(n):
+        return numpy.ones(n, dtype=bool)
+
+    def _isin(col, values):
+        return numpy.isin(col, values)
+
+    def _between(col, start, end):
+        return (col >= start) & (col <= end)
+
+    def _has_any_bit(col, mask):
+        return (col >= 0) & ((col & mask) != 0)
+
+    def _present(col):
+        return col >= 0
+
+    def _and(a, b):
+        return a & b
+
+    def _or(a, b):
+        return a | b
+
+    def _true_indices(mask):
+        return numpy.flatnonzero(mask).tolist()
+
+else:
+
+    def _column(values):
+        return array('q', values)
+
+    def _all(n):
+        return [True] * n
+
+    def _isin(col, values):
+        values = set(values)
+        return [v in values for v in col]
+
+    def _between(col, start, end):
+        return [start <= v <= end for v in col]
+
+    def _has_any_bit(col, mask):
+        return [v >= 0 and v & mask != 0 for v in col]
+
+    def _present(col):
+        return [v >= 0 for v in col]
+
+    def _and(a, b):
+        return [x and y for x, y in zip(a, b)]
+
+    def _or(a, b):
+        return [x or y for x, y in zip(a, b)]
+
+    def _true_indices(mask):
+        return [i for i, m in enumerate(mask) if m]
+
+class _Dictionary:
+    """Maps each distinct value of a text attribute to an int code."""
+
+    def __init__(self):
+        self.codes = {}
+
+    def encode(self, value):
+        return self.codes.setdefault(value, len(self.codes))
+
+    def lookup(self, values):
+        """Return the codes of those of `values` which are present."""
+        return [self.codes[v] for v in values if v in self.codes]
+
+class ColumnarStore:
+    """The events of `timetable`, held as parallel columns.  Rows are in
+    the same order as the entries of the timetable's EventIndex."""
+
+    text_fields = ('coordinator', 'location', 'name', 'code')
+
+    def __init__(self, timetable):
+        self.entries = timetable.index.entries
+        self.dictionaries = {f: _Dictionary() for f in self.text_fields}
+        columns = {f: [] for f in ('starts', 'ends', 'date', 'day_of_week',
+                                    'week_num', 'month', 'tutorial_mask',
+                                    'seminar_mask') + self.text_fields}
+        for event, week, day in self.entries:
+            columns['starts'].append(_minutes(event.starts))
+            columns['ends'].append(_minutes(event.ends))
+            columns['date'].append(day.date.toordinal())
+            columns['day_of_week'].append(day.date.weekday())
+            columns['week_num'].append(MISSING if week.num is None else week.num)
+            columns['month'].append(day.date.month)
+            for field in ('tutorial_mask', 'seminar_mask'):
+                mask = getattr(event, field)
+                columns[field].append(MISSING if mask is None else mask)
+            for field in self.text_fields:
+                columns[field].append(
+                    self.dictionaries[field].encode(getattr(event, field)))
+        self.columns = {f: _column(v) for f, v in columns.items()}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _equals(self, field, term, encode):
+        values = _term_values(term)
+        if values is None:
+            return None
+        return _isin(self.columns[field], encode(values))
+
+    def _groups(self, field, registry, term):
+        values = _term_values(term)
+        if values is None:
+            return _present(self.columns[field])
+        mask = 0
+        for g in values:
+            mask |= registry.bit(g)
+        return _has_any_bit(self.columns[field], mask)
+
+    def _group_masks(self, sq):
+        return [self._groups('tutorial_mask', tutorial_group_registry,
+                                sq.tutorial_group),
+                self._groups('seminar_mask', seminar_group_registry,
+                                sq.seminar_group)]
+
+    def mask(self, sq):
+        """Return a boolean mask over the rows of this store, true for
+        those events which match `sq`."""
+        n = len(self)
+        terms = self._group_masks(sq) + [
+            self._equals('starts', sq.starts,
+                            lambda vs: [_minutes(v) for v in vs]),
+            self._equals('ends', sq.ends,
+                            lambda vs: [_minutes(v) for v in vs]),
+            self._equals('date', sq.date,
+                            lambda vs: [v.toordinal() for v in vs]),
+            self._equals('day_of_week', sq.day_of_week, list),
+            self._equals('week_num', sq.week_num, list),
+            self._equals('month', sq.month, list)
+            ]
+        for field in self.text_fields:
+            terms.append(self._equals(field, getattr(sq, field),
+                                        self.dictionaries[field].lookup))
+        if isinstance(sq.daterange, TimeRange):
+            terms.append(_between(self.columns['date'],
+                                    sq.daterange.start.toordinal(),
+                                    sq.daterange.end.toordinal()))
+        if isinstance(sq.timerange, TimeRange):
+            start = _minutes(sq.timerange.start)
+            end = _minutes(sq.timerange.end)
+            terms.append(_or(_between(self.columns['starts'], start, end),
+                                _between(self.columns['ends'], start, end)))
+        result = _all(n)
+        for term in terms:
+            if term is not None:
+                result = _and(result, term)
+        return result
+
+    def match_ids(self, sq):
+        """Return the row numbers (ie, EventIndex IDs) of the events
+        matching `sq`, in timetable order."""
+        return _true_indices(self.mask(sq))
+
+    def iter_matches(self, sq):
+        """Generate the entries of the events matching `sq`, as
+        Timetable.iter_matches does."""
+        entries = self.entries
+        return (entries[i] for i in self.match_ids(sq))
+
+    def filter(self, sq):
+        """Return a new Timetable containing only those events which
+        match `sq`, as Timetable.filter does."""
+        return Timetable.from_entries(self.iter_matches(sq))
+
+    def filter_many(self, queries):
+        """Return a new Timetable for each of `queries`, as
+        Timetable.filter_many does.  The mask for the terms other than
+        groups is computed once for each set of queries sharing them."""
+        entries = self.entries
+        shared = {}
+        for i, sq in enumerate(queries):
+            shared.setdefault(sq.without_groups(), []).append(i)
+        results = [None] * len(queries)
+        for common, members in shared.items():
+            common_mask = self.mask(common)
+            for i in members:
+                mask = common_mask
+                for group_mask in self._group_masks(queries[i]):
+                    mask = _and(mask, group_mask)
+                results[i] = Timetable.from_entries(
+                    entries[j] for j in _true_indices(mask))
+        return results
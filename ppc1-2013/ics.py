@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+"""Export of timetable events as an iCalendar (RFC 5545) calendar, for
+subscribing to from calendar applications.
+
+Times are written as "floating" local times, as they appear in the
+timetable.  Every property of an event, including its DTSTAMP, depends
+only on the event, so the same events always give the same calendar.
+"""
+
+import hashlib
+import datetime
+
+PRODID = '-//PPC1 2013 timetable//EN'
+UID_DOMAIN = 'ppc1-2013'
+
+# An event with a start time but no end time is given this duration
+DEFAULT_DURATION = datetime.timedelta(hours=1)
+
+def _escape(text):
+    return (text.replace('\\', '\\\\').replace(';', '\\;')
+            .replace(',', '\\,').replace('\n', '\\n'))
+
+def _fold(line):
+    """Fold `line` into lines of at most 75 octets, each continuation
+    line starting with a space, joined by CRLF."""
+    encoded = line.encode('utf-8')
+    if len(encoded) <= 75:
+        return line + '\r\n'
+    lines = []
+    start = 0
+    limit = 75
+    while start < len(encoded):
+        end = min(start + limit, len(encoded))
+        # Don't split a multi-byte character
+        while end < len(encoded) and encoded[end] & 0xC0 == 0x80:
+            end -= 1
+        lines.append(encoded[start:end].decode('utf-8'))
+        start = end
+        limit = 74
+    return '\r\n '.join(lines) + '\r\n'
+
+def _datetime(date, time):
+    return datetime.datetime.combine(date, time).strftime('%Y%m%dT%H%M%S')
+
+def _uid(event, day):
+    key = '|'.join(str(v) for v in (day.date, event.starts, event.ends,
+                                    event.code, event.name, event.location,
+                                    event.tutorial_mask, event.seminar_mask))
+    return '{}@{}'.format(hashlib.sha1(key.encode('utf-8')).hexdigest(),
+                            UID_DOMAIN)
+
+def _vevent(event, day):
+    lines = ['BEGIN:VEVENT',
+                'UID:{}'.format(_uid(event, day)),
+                'DTSTAMP:{}Z'.format(day.date.strftime('%Y%m%dT000000'))]
+    if event.starts is None:
+        lines.append('DTSTART;VALUE=DATE:{}'.format(
+            day.date.strftime('%Y%m%d')))
+    else:
+        lines.append('DTSTART:{}'.format(_datetime(day.date, event.starts)))
+        if event.ends is not None and event.ends > event.starts:
+            lines.append('DTEND:{}'.format(_datetime(day.date, event.ends)))
+        else:
+            lines.append('DURATION:PT{}M'.format(
+                DEFAULT_DURATION.seconds // 60))
+    summary = ' '.join(v for v in (event.code, event.name) if v)
+    lines.append('SUMMARY:{}'.format(_escape(summary)))
+    if event.location:
+        lines.append('LOCATION:{}'.format(_escape(event.location)))
+    if event.coordinator:
+        lines.append('DESCRIPTION:{}'.format(
+            _escape('Coordinator: {}'.format(event.coordinator))))
+    lines.append('END:VEVENT')
+    return lines
+
+def iter_ics(entries, name):
+    """Generate the iCalendar text, line by line, of a calendar called
+    `name` containing the events in `entries`, an iterable of (event,
+    week, day) tuples (see EventIndex)."""
+    header = ['BEGIN:VCALENDAR',
+                'VERSION:2.0',
+                'PRODID:{}'.format(PRODID),
+                'CALSCALE:GREGORIAN',
+                'X-WR-CALNAME:{}'.format(_escape(name))]
+    for line in header:
+        yield _fold(line)
+    for event, week, day in entries:
+        for line in _vevent(event, day):
+            yield _fold(line)
+    yield _fold('END:VCALENDAR')
+
+def to_ics(entries, name):
+    return ''.join(iter_ics(entries, name))
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+"""Incremental re-ingestion of a new release of the master timetable.
+
+Rather than replacing the loaded Timetable (and discarding every cached
+search), the new release is compared with it day by day, only the days
+whose events have changed are replaced, and only the cached searches
+which could match an event on one of those days are dropped (the rest
+are carried over to the new version; see carry_over_cached).
+
+    python3 ingest.py NEW_RELEASE [tt.json]
+
+prints the days which differ between NEW_RELEASE and tt.json, and writes
+the merged timetable back to tt.json.  NEW_RELEASE may be a timetable
+JSON file or ps2ascii output, which is parsed with ../parser.py.
+"""
+
+import os
+import sys
+import json
+
+from timetable import Timetable, Week, Day, SearchQuery
+from cache import versioned_key, split_key
+
+def _event_key(event):
+    return json.dumps(event.to_dict(), sort_keys=True)
+
+def _day_key(week, day):
+    """A value which differs between two days if any of their events, or
+    the week they are in, differ."""
+    return (week.num, week.commences, [_event_key(e) for e in day.events])
+
+class TimetableDiff:
+    """The differences between two timetables: the dates whose events
+    differ, and the events (from either timetable) on those dates."""
+
+    def __init__(self):
+        self.changed_dates = []
+        self.old_events = []
+        self.new_events = []
+
+    def __bool__(self):
+        return bool(self.changed_dates)
+
+    def affected_events(self):
+        """Events from either timetable on a changed date.  A search
+        whose result is affected by the change matches at least one."""
+        return self.old_events + self.new_events
+
+def diff_timetables(old, new):
+    """Return a TimetableDiff of the Timetables `old` and `new`."""
+    old_days = {d.date: (w, d) for w in old.weeks for d in w.days}
+    new_days = {d.date: (w, d) for w in new.weeks for d in w.days}
+    diff = TimetableDiff()
+    for date in sorted(set(old_days) | set(new_days)):
+        old_day = old_days.get(date)
+        new_day = new_days.get(date)
+        if (old_day and new_day
+                and _day_key(*old_day) == _day_key(*new_day)):
+            continue
+        diff.changed_dates.append(date)
+        if old_day:
+            diff.old_events.extend(old_day[1].events)
+        if new_day:
+            diff.new_events.extend(new_day[1].events)
+    return diff
+
+def _find_week(tt, num, commences):
+    """Return the week of `tt` with the given number and start date,
+    adding it (in order) if there is none."""
+    for w in tt.weeks:
+        if w.num == num and w.commences == commences:
+            return w
+    week = Week(num, commences)
+    tt.weeks.append(week)
+    tt.weeks.sort(key=lambda w: w.commences)
+    return week
+
+def _copy_timetable(tt):
+    """Return a copy of `tt` with its own Weeks and Days, so that they
+    can be changed without affecting `tt`.  The Events are shared, as
+    apply_diff never changes those of `tt`."""
+    copy = Timetable()
+    for week in tt.weeks:
+        new_week = Week(week.num, week.commences)
+        for day in week.days:
+            new_day = Day(new_week, date=day.date)
+            new_day.events.extend(day.events)
+            new_week.days.append(new_day)
+        copy.weeks.append(new_week)
+    return copy
+
+def apply_diff(old, new, diff):
+    """Return a new Timetable which matches `new` on the dates in `diff`
+    and has the days (and events) of the Timetable `old` on every other
+    date.  `old` itself is left unchanged, so it can carry on being
+    searched while the result is built."""
+    tt = _copy_timetable(old)
+    changed = set(diff.changed_dates)
+    new_days = {d.date: (w, d) for w in new.weeks for d in w.days
+                if d.date in changed}
+    # Remove the old versions of the changed days
+    for week in tt.weeks:
+        week.days = [d for d in week.days if d.date not in changed]
+    for date in diff.changed_dates:
+        if date not in new_days:
+            continue
+        new_week, new_day = new_days[date]
+        week = _find_week(tt, new_week.num, new_week.commences)
+        day = Day(week, date=date)
+        for event in new_day.events:
+            event.week = week
+            event.day = day
+            day.events.append(event)
+        week.days.append(day)
+        week.days.sort(key=lambda d: d.date)
+    tt.weeks = [w for w in tt.weeks if w.days]
+    tt.build_index()
+    return tt
+
+def carry_over_cached(cache, diff, old_version, new_version):
+    """Copy the pages in `cache` for the timetable version `old_version`
+    (see cache.versioned_key) whose searches cannot be affected by
+    `diff` to the same searches in `new_version`, so that they stay
+    cached once the changed timetable is swapped in.  Return the number
+    of pages not carried over."""
+    events = diff.affected_events()
+    dropped = 0
+    for key in cache.keys():
+        version, query_key = split_key(key)
+        if version != old_version:
+            continue
+        query = SearchQuery.from_cache_key(query_key)
+        if any(query.matches(e) for e in events):
+            dropped += 1
+        else:
+            cache.copy(key, versioned_key(new_version, query))
+    return dropped
+
+def load_release(fname):
+    """Load a new release of the timetable from `fname`, which is either
+    a timetable JSON file or the ps2ascii output of the timetable PDF."""
+    if fname.endswith('.json'):
+        return Timetable(fname)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from parser import Parser
+    with open(fname) as f:
+        return Parser().parse_file(f)
+
+if __name__ == '__main__':
+    from sys import argv
+    release_fname = argv[1]
+    tt_fname = argv[2] if len(argv) > 2 else 'tt.json'
+    tt = Timetable(tt_fname)
+    new = load_release(release_fname)
+    diff = diff_timetables(tt, new)
+    for date in diff.changed_dates:
+        print('Changed: {}'.format(date))
+    if diff:
+        apply_diff(tt, new, diff).save(tt_fname)
@@ -1,55 +1,482 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from flask import Flask, render_template, request, flash
+from flask import (Flask, Response, render_template, request, flash,
+                    abort, jsonify, redirect, url_for)
 from timetable import (Timetable, SearchQuery, MultiSearchTerm,
-                        TimeRange, Any)
+                        TimeRange, Any, all_tutorial_groups,
+                        all_seminar_groups, entry_to_dict)
+from cache import LRUCache, SQLiteCache, versioned_key, split_key
+from snapshot import open_timetable
+from columnar import ColumnarStore
+from ingest import diff_timetables, apply_diff, carry_over_cached
+from watcher import FileWatcher
+from materialise import (MaterialisedPages, group_queries,
+                            gzip_compressor, gzip_page)
+from ics import to_ics
+from batch import run_batch
+from singleflight import SingleFlight
+from metrics import Registry, profile
 
+import os
+import hmac
+import json
+import gzip
+import hashlib
 import datetime
+import threading
+import time
+from itertools import islice
+from urllib.parse import urlencode
 
 TT_JSON_FILE = 'tt.json'
+# Compiled from TT_JSON_FILE (see snapshot.py) when missing or out of date
+TT_SNAPSHOT_FILE = 'tt.snap'
+
+# If set, load the snapshot lazily, decoding each week only when a
+# search first needs it (see snapshot.load_snapshot_lazily).
+TT_LAZY_LOAD = bool(os.environ.get('TT_LAZY_LOAD'))
+
+# Pages precomputed from TT_JSON_FILE by materialise.py, served in place
+# of searching for the most common queries
+MATERIALISED_DIR = os.environ.get('MATERIALISED_DIR', 'materialised')
+
+# Maximum total size of the pages (gzip-compressed) held in the search
+# cache, and optionally the number of seconds after which a cached page
+# expires.
+SEARCH_CACHE_MAX_BYTES = int(os.environ.get('SEARCH_CACHE_MAX_BYTES',
+                                            64 * 1024 * 1024))
+SEARCH_CACHE_TTL = (float(os.environ['SEARCH_CACHE_TTL'])
+                    if os.environ.get('SEARCH_CACHE_TTL') else None)
+
+# 'memory' keeps a separate search cache in each worker process;
+# 'sqlite' keeps one cache, in the file at SEARCH_CACHE_PATH, shared by
+# every worker on the machine.
+SEARCH_CACHE_BACKEND = os.environ.get('SEARCH_CACHE_BACKEND', 'memory')
+SEARCH_CACHE_PATH = os.environ.get('SEARCH_CACHE_PATH', 'search_cache.sqlite')
+
+# 'index' searches using the timetable's inverted index; 'columnar'
+# evaluates each search over a column-oriented copy of the events.
+SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'index')
+if TT_LAZY_LOAD and SEARCH_BACKEND == 'columnar':
+    # The columnar copy is built from every event at startup, so would
+    # decode every week and defeat lazy loading.
+    raise ValueError('TT_LAZY_LOAD cannot be used with '
+                        'SEARCH_BACKEND=columnar')
+
+# With the 'sqlite' search cache, workers use this lock file to avoid
+# rendering the same page at the same time as each other.
+SEARCH_LOCK_PATH = os.environ.get('SEARCH_LOCK_PATH', 'search_cache.lock')
+
+# zlib compression level of pages rendered on demand, which are compressed
+# as they are streamed.  (Materialised pages are compressed harder.)
+LIVE_COMPRESS_LEVEL = 6
+
+# If set, render the timetable for every tutorial group / seminar group
+# pair in the background at startup.
+PREWARM_CACHE = bool(os.environ.get('PREWARM_CACHE'))
+
+# How often (in seconds) to check TT_JSON_FILE for changes, reloading the
+# timetable when it has changed; 0 disables the check.
+TT_RELOAD_INTERVAL = float(os.environ.get('TT_RELOAD_INTERVAL', 5))
+
+# Maximum number of queries in one request to /api/batch
+MAX_BATCH_QUERIES = 1000
+
+# If set, enables the /admin/ endpoints for requests sending this value
+# in an X-Admin-Token header.
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
 
 app = Flask(__name__)
 
-tt = Timetable(TT_JSON_FILE)
+def _make_searcher(tt):
+    """Return the object whose filter() method is used to search `tt`."""
+    return ColumnarStore(tt) if SEARCH_BACKEND == 'columnar' else tt
+
+def _searchable_codes(tt):
+    # Events without a code are days off, which are never returned by a
+    # search, so a search for every other code is a search for any code.
+    return tt.codes() - {None}
+
+class TimetableData:
+    """The loaded timetable and everything derived from it.  Reloading
+    builds a new TimetableData and swaps it in whole, so a request which
+    has already read `data` uses one version of the timetable throughout,
+    even if a reload finishes while it is being handled."""
+
+    def __init__(self, tt):
+        self.tt = tt
+        self.searcher = _make_searcher(tt)
+        self.all_codes = _searchable_codes(tt)
+        self.version = tt.digest()
+        self.pages = MaterialisedPages(MATERIALISED_DIR, self.version)
+        # Maps SearchQuery -> gzip-compressed iCalendar feed, filled as
+        # feeds are requested
+        self.feeds = {}
+
+data = TimetableData(open_timetable(TT_JSON_FILE, TT_SNAPSHOT_FILE,
+                                    TT_LAZY_LOAD))
+# Held while a new version of the timetable is being swapped in
+_reload_lock = threading.Lock()
+all_weekdays = set(range(7))
+
+if SEARCH_CACHE_BACKEND == 'sqlite':
+    search_cache = SQLiteCache(SEARCH_CACHE_PATH, SEARCH_CACHE_MAX_BYTES,
+                                SEARCH_CACHE_TTL)
+else:
+    search_cache = LRUCache(SEARCH_CACHE_MAX_BYTES, SEARCH_CACHE_TTL)
+# Pages are cached under cache.versioned_key(version, query)
+
+# Identical searches which miss the cache at the same time are rendered
+# once; the other requests wait for that page.
+search_flight = SingleFlight(
+    SEARCH_LOCK_PATH if SEARCH_CACHE_BACKEND == 'sqlite' else None)
+
+# Metrics of this worker's searches, served at /metrics
+metrics = Registry()
+search_stage_seconds = metrics.histogram(
+    'timetable_search_stage_seconds',
+    'Time spent in each stage of handling a search',
+    labelnames=('stage',))
+search_results = metrics.counter(
+    'timetable_search_results_total',
+    'Searches by where their page came from',
+    labelnames=('source',))
+search_result_events = metrics.histogram(
+    'timetable_search_result_events',
+    'Number of events in each page rendered',
+    buckets=(0, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000))
+search_response_bytes = metrics.histogram(
+    'timetable_search_response_bytes',
+    'Size of the body of each search response',
+    buckets=(1024, 4096, 16384, 65536, 262144, 1048576, 4194304))
+metrics.gauge('timetable_search_cache', 'Search cache statistics',
+                lambda: {(k,): v for k, v in search_cache.stats().items()
+                        if v is not None},
+                labelnames=('stat',))
+metrics.gauge('timetable_search_flight', 'Single-flight rendering statistics',
+                lambda: {(k,): v for k, v in search_flight.stats().items()},
+                labelnames=('stat',))
+
+def prewarm_cache():
+    """Add the timetable for each pair of tutorial group and seminar
+    group to the search cache, stopping early if the cache fills or the
+    timetable is reloaded.  Pairs with a materialised page are skipped."""
+    current = data
+    for query in group_queries():
+        key = versioned_key(current.version, query)
+        if query in current.pages or key in search_cache:
+            continue
+        result = gzip_page(current.searcher.filter(query).to_html())
+        if current is not data:
+            return
+        if not search_cache.would_fit(result):
+            app.logger.info('Search cache full; stopped pre-warming.')
+            return
+        search_cache[key] = result
+    app.logger.info('Pre-warmed search cache: %s', search_cache.stats())
 
-search_cache = {}
+def ingest_release(new_tt):
+    """Apply the differences between the loaded timetable and `new_tt`
+    (a new release of the timetable) to a copy of the loaded timetable,
+    swap the copy in (as reload_timetable does) and write it to
+    TT_JSON_FILE, from which the other workers reload it.  Cached
+    searches which the differences cannot affect are carried over to
+    the new version.  Return the TimetableDiff and the number of cached
+    searches not carried over."""
+    global data
+    with _reload_lock:
+        old_data = data
+        diff = diff_timetables(old_data.tt, new_tt)
+        if not diff:
+            return diff, 0
+        new_data = TimetableData(apply_diff(old_data.tt, new_tt, diff))
+        new_data.tt.save(TT_JSON_FILE)
+        data = new_data
+    return diff, carry_over_cached(search_cache, diff, old_data.version,
+                                    new_data.version)
 
-def _add_date(request, terms):
-    date = request.form.get('date')
+def reload_timetable():
+    """Load TT_JSON_FILE again and, if it differs from the loaded
+    timetable, swap it in.  The new timetable and its indexes are built
+    before the swap, so searches carry on against the old one in the
+    meantime.  Cached pages are keyed by version, so none from the old
+    timetable can be served once the new one is in place; they are
+    removed only to free space.  Return whether it changed."""
+    global data
+    new_data = TimetableData(open_timetable(TT_JSON_FILE, TT_SNAPSHOT_FILE,
+                                            TT_LAZY_LOAD))
+    with _reload_lock:
+        if new_data.version == data.version:
+            return False
+        data = new_data
+    search_cache.invalidate(lambda key: split_key(key)[0] != new_data.version)
+    app.logger.info('Reloaded timetable (version %s)', new_data.version)
+    return True
+
+def _check_admin():
+    token = request.headers.get('X-Admin-Token', '')
+    if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN):
+        abort(404)
+
+def _normalise_terms(terms, all_codes):
+    """Replace multiple-value terms which cover every possible value
+    with Any, so that they share cache entries with (and are as cheap
+    to run as) unconstrained searches."""
+    if set(terms.get('code', Any)) >= all_codes:
+        terms['code'] = Any
+    if set(terms.get('day_of_week', Any)) >= all_weekdays:
+        terms['day_of_week'] = Any
+
+def _add_date(params, terms):
+    date = params.get('date')
     if date == 'all':
         terms['date'] = Any
     elif date == 'today':
         terms['date'] = datetime.date.today()
     elif date == 'single':
         terms['date'] = datetime.date(
-            int(request.form.get('date_year')),
-            int(request.form.get('date_month')),
-            int(request.form.get('date_day')))
+            int(params.get('date_year')),
+            int(params.get('date_month')),
+            int(params.get('date_day')))
     elif date == 'range':
         start = datetime.date(
-            int(request.form.get('date_start_year')),
-            int(request.form.get('date_start_month')),
-            int(request.form.get('date_start_day')))
+            int(params.get('date_start_year')),
+            int(params.get('date_start_month')),
+            int(params.get('date_start_day')))
         end = datetime.date(
-            int(request.form.get('date_end_year')),
-            int(request.form.get('date_end_month')),
-            int(request.form.get('date_end_day')))
+            int(params.get('date_end_year')),
+            int(params.get('date_end_month')),
+            int(params.get('date_end_day')))
         terms['daterange'] = TimeRange(start, end)
 
-def _add_timerange(request, terms):
-    time = request.form.get('time')
+def _add_timerange(params, terms):
+    time = params.get('time')
     if time == 'all':
         terms['timerange'] = Any
     elif time == 'range':
-        start_hour = int(request.form.get('time_start_hour'))
-        start_min = int(request.form.get('time_start_min'))
+        start_hour = int(params.get('time_start_hour'))
+        start_min = int(params.get('time_start_min'))
         start = datetime.time(start_hour, start_min)
-        end_hour = int(request.form.get('time_end_hour'))
-        end_min = int(request.form.get('time_end_min'))
+        end_hour = int(params.get('time_end_hour'))
+        end_min = int(params.get('time_end_min'))
         end = datetime.time(end_hour, end_min)
         terms['timerange'] = TimeRange(start, end)
 
+def _parse_search(params, require_all=True):
+    """Parse the search form fields in `params` (the form data of a POST
+    or the query string of a GET).  Return a dict of SearchQuery terms
+    and a list of error messages.  Unless `require_all` is true, a
+    group, code or weekday field which is left out matches any value."""
+    error_msgs = []
+    terms = {}
+    def given(field):
+        return require_all or field in params
+    if given('tutorial_group'):
+        try:
+            terms['tutorial_group'] = int(params.get('tutorial_group'))
+        except (ValueError, TypeError):
+            error_msgs.append('Invalid value for tutorial group.')
+    if given('seminar_group'):
+        terms['seminar_group'] = params.get('seminar_group')
+    if given('code'):
+        terms['code'] = MultiSearchTerm(*params.getlist('code'))
+    if given('weekday'):
+        try:
+            terms['day_of_week'] = MultiSearchTerm(
+                *(int(i) for i in params.getlist('weekday')))
+        except ValueError:
+            error_msgs.append('Invalid value for weekday.')
+    try:
+        _add_date(params, terms)
+    except (ValueError, TypeError):
+        error_msgs.append('Invalid value for date.')
+    try:
+        _add_timerange(params, terms)
+    except (ValueError, TypeError):
+        error_msgs.append('Invalid value for time.')
+    return terms, error_msgs
+
+def _canonical_params(params, terms):
+    """Return the search given by the form fields `params` (parsed into
+    `terms`) as a sorted list of (field, value) pairs.  Searches which
+    differ only in the order or spelling of their fields (eg, '03' for
+    '3', repeated codes, or fields unused by the chosen date or time
+    option) give the same list, so each search has one URL."""
+    pairs = [('tutorial_group', terms['tutorial_group']),
+                ('seminar_group', terms['seminar_group'])]
+    pairs.extend(('code', c) for c in set(terms['code']))
+    pairs.extend(('weekday', d) for d in set(terms['day_of_week']))
+    date = params.get('date')
+    if date in ('all', 'today'):
+        pairs.append(('date', date))
+    elif date == 'single':
+        d = terms['date']
+        pairs.extend([('date', date), ('date_year', d.year),
+                        ('date_month', d.month), ('date_day', d.day)])
+    elif date == 'range':
+        start, end = terms['daterange']
+        pairs.extend([('date', date),
+                        ('date_start_year', start.year),
+                        ('date_start_month', start.month),
+                        ('date_start_day', start.day),
+                        ('date_end_year', end.year),
+                        ('date_end_month', end.month),
+                        ('date_end_day', end.day)])
+    time = params.get('time')
+    if time == 'all':
+        pairs.append(('time', time))
+    elif time == 'range':
+        start, end = terms['timerange']
+        pairs.extend([('time', time),
+                        ('time_start_hour', start.hour),
+                        ('time_start_min', start.minute),
+                        ('time_end_hour', end.hour),
+                        ('time_end_min', end.minute)])
+    return sorted((field, str(value)) for field, value in pairs
+                    if value is not None)
+
+def _etag(key, current, gzipped):
+    """Return a strong ETag for the resource identified by the string
+    `key` (eg, the cache key of a search) in the version of the timetable
+    `current`, which is all the resource depends on.  The gzip-compressed
+    and uncompressed resources have different ETags."""
+    key = '{}:{}'.format(current.version, key)
+    etag = hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+    return etag + '-gz' if gzipped else etag
+
+def _accepts_gzip():
+    # The quality of gzip (or *), which is 0 if it is refused (q=0)
+    return request.accept_encodings['gzip'] > 0
+
+def _not_modified(etag):
+    return (request.method in ('GET', 'HEAD')
+            and etag in request.if_none_match)
+
+def _gzipped_response(body, gzipped, mimetype='text/html'):
+    """Return a Response for the gzip-compressed document `body`,
+    decompressing it first if `gzipped` is false."""
+    if gzipped:
+        response = Response(body, mimetype=mimetype)
+        response.headers['Content-Encoding'] = 'gzip'
+        return response
+    return Response(gzip.decompress(body), mimetype=mimetype)
+
+def _stream_and_cache(query, timetable, current, gzipped):
+    """Yield the HTML for `timetable` chunk by chunk (gzip-compressed
+    if `gzipped`), adding the compressed page to the search cache once it
+    has all been sent, unless the timetable has been reloaded since the
+    search was made.  Each page is compressed once, as it is sent,
+    whether or not the client accepts gzip."""
+    compressor = gzip_compressor(LIVE_COMPRESS_LEVEL)
+    compressed = []
+    # Time spent rendering and compressing, not waiting for the client
+    render_secs = 0.0
+    sent = 0
+    start = time.perf_counter()
+    for chunk in timetable.iter_html():
+        encoded = chunk.encode('utf-8')
+        compressed.append(compressor.compress(encoded))
+        out = compressed[-1] if gzipped else encoded
+        if out:
+            render_secs += time.perf_counter() - start
+            sent += len(out)
+            yield out
+            start = time.perf_counter()
+    compressed.append(compressor.flush())
+    render_secs += time.perf_counter() - start
+    search_stage_seconds.observe(render_secs, 'render')
+    if gzipped:
+        sent += len(compressed[-1])
+        yield compressed[-1]
+    search_response_bytes.observe(sent)
+    page = b''.join(compressed)
+    if current is data:
+        search_cache[versioned_key(current.version, query)] = page
+
+def lookup_page(query, current):
+    """Return the gzip-compressed page for `query` in the timetable
+    `current` if it has been materialised or cached, or None."""
+    page = current.pages.get(query)
+    if page is None:
+        page = search_cache.get(versioned_key(current.version, query))
+    return page
+
+def _peek_page(query, current):
+    """Return the cached page for `query` in the timetable `current`, as
+    lookup_page does, but without counting a cache hit or miss (for
+    polling the cache while another worker renders the page)."""
+    return search_cache.peek(versioned_key(current.version, query))
+
+def _count_events(tt):
+    return sum(len(d.events) for w in tt.weeks for d in w.days)
+
+def render_page(query, current):
+    """Render the page for `query` in the timetable `current`, add it to
+    the search cache (unless the timetable has since been reloaded) and
+    return it gzip-compressed."""
+    with search_stage_seconds.time('filter'):
+        new_tt = current.searcher.filter(query)
+    search_result_events.observe(_count_events(new_tt))
+    with search_stage_seconds.time('render'):
+        page = gzip_page(new_tt.to_html(), LIVE_COMPRESS_LEVEL)
+    if current is data:
+        search_cache[versioned_key(current.version, query)] = page
+    return page
+
+def _search_response(query, current):
+    """Return the response to the search `query` of the timetable
+    `current`.  This is 304 Not Modified (for a GET request from a client
+    which already has the page), the materialised or cached page, or
+    failing those, the page rendered as it is sent.  Of simultaneous
+    requests for the same page which is not cached, only one renders it
+    (see search_flight); the others are sent that page once it is
+    ready.  That one renders the whole page before sending any of it, so
+    that the others do not wait for its client to receive it."""
+    gzipped = _accepts_gzip()
+    etag = _etag(query.cache_key(), current, gzipped)
+    if _not_modified(etag):
+        search_results.inc('not_modified')
+        response = Response(status=304)
+    else:
+        with search_stage_seconds.time('lookup'):
+            page = lookup_page(query, current)
+        if page is not None:
+            search_results.inc('materialised' if query in current.pages
+                                else 'cache')
+        call = None
+        if page is None:
+            with search_stage_seconds.time('wait'):
+                call, page = search_flight.begin(
+                    versioned_key(current.version, query),
+                    lambda: _peek_page(query, current))
+            if page is not None:
+                search_results.inc('shared')
+        if page is not None:
+            response = _gzipped_response(page, gzipped)
+            search_response_bytes.observe(response.content_length)
+        elif call is not None:
+            search_results.inc('rendered')
+            try:
+                page = render_page(query, current)
+            finally:
+                search_flight.finish(call, page)
+            response = _gzipped_response(page, gzipped)
+            search_response_bytes.observe(response.content_length)
+        else:
+            search_results.inc('rendered')
+            with search_stage_seconds.time('filter'):
+                new_tt = current.searcher.filter(query)
+            search_result_events.observe(_count_events(new_tt))
+            response = Response(_stream_and_cache(query, new_tt, current,
+                                                    gzipped),
+                                mimetype='text/html')
+            if gzipped:
+                response.headers['Content-Encoding'] = 'gzip'
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
 @app.route('/')
 def main():
     return render_template('index.html')
@@ -58,39 +485,185 @@ def main():
 def show_search_form():
     return render_template('search_form.html', error_msgs=[])
 
-@app.route('/timetable', methods=['POST'])
+@app.route('/timetable', methods=['GET', 'POST'])
 def handle_search():
-    error_msgs = []
-    terms = {}
-    terms['tutorial_group'] = int(request.form.get('tutorial_group'))
-    terms['seminar_group'] = request.form.get('seminar_group')
-    terms['code'] = MultiSearchTerm(*request.form.getlist('code'))
-    terms['day_of_week'] = MultiSearchTerm(*(int(i) for i in request.form.getlist('weekday')))
-    try:
-        _add_date(request, terms)
-    except ValueError:
-        error_msgs.append('Invalid value for date.')
-    try:
-        _add_timerange(request, terms)
-    except ValueError:
-        error_msgs.append('Invalid value for time.')
-        
+    """Search the timetable.  The search form is POSTed here and
+    redirected to the search's canonical URL (see _canonical_params), a
+    GET of which returns the results, so that browsers and HTTP caches
+    can store and reuse them.  A request with the admin token and an
+    X-Profile header (naming one of metrics.PROFILE_SORTS) is profiled,
+    and the profile returned instead of the page."""
+    sort = request.headers.get('X-Profile')
+    if sort is not None:
+        _check_admin()
+        return _profiled(_handle_search, sort)
+    return _handle_search()
+
+def _profiled(view, sort):
+    """Return a text response giving the profile (see metrics.profile)
+    of calling `view` and sending its whole response, in place of that
+    response."""
+    def call():
+        response = app.make_response(view())
+        return response, len(response.get_data())
+    (response, size), stats = profile(call, sort)
+    text = '{} ({} bytes)\n\n{}'.format(response.status, size, stats)
+    response = Response(text, mimetype='text/plain')
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+def _handle_search():
+    params = request.form if request.method == 'POST' else request.args
+    with search_stage_seconds.time('parse'):
+        terms, error_msgs = _parse_search(params)
+        if not error_msgs:
+            canonical = urlencode(_canonical_params(params, terms))
     if error_msgs:
         # Pass error messages directly to template rather than
         # flashing, which requires app.secret_key to be set.
         return render_template('search_form.html', error_msgs=error_msgs)
+    if request.method == 'POST':
+        return redirect('{}?{}'.format(url_for('handle_search'), canonical),
+                        code=303)
+    elif request.query_string.decode('ascii', 'replace') != canonical:
+        return redirect('{}?{}'.format(url_for('handle_search'), canonical),
+                        code=301)
     else:
+        current = data
+        _normalise_terms(terms, current.all_codes)
         query = SearchQuery(**terms)
-        cached_result = search_cache.get(query)
-        if cached_result:
-            #print('found cached result')
-            return cached_result
-        else:
-            new_tt = tt.filter(query)
-            result = new_tt.to_html()
-            search_cache[query] = result
-            #print('caching result')
-            return result
+        return _search_response(query, current)
+
+# Seminar groups as they appear in feed URLs, eg 'red-b' for 'Red B'
+_seminar_group_slugs = {g.replace(' ', '-').lower(): g
+                        for g in all_seminar_groups}
+
+@app.route('/ics/<int:tutorial_group>/<seminar_group>.ics')
+def group_feed(tutorial_group, seminar_group):
+    """Return the iCalendar feed of the events for one tutorial group
+    and seminar group, for calendar applications to subscribe to.  Each
+    feed is generated when first requested and kept (compressed) until
+    the timetable is reloaded; clients polling with If-None-Match get a
+    304 unless the timetable has changed."""
+    seminar_group = _seminar_group_slugs.get(seminar_group)
+    if tutorial_group not in all_tutorial_groups or seminar_group is None:
+        abort(404)
+    current = data
+    query = SearchQuery(tutorial_group=tutorial_group,
+                        seminar_group=seminar_group)
+    gzipped = _accepts_gzip()
+    etag = _etag('ics:' + query.cache_key(), current, gzipped)
+    if _not_modified(etag):
+        response = Response(status=304)
+    else:
+        feed = current.feeds.get(query)
+        if feed is None:
+            name = 'PPC1 timetable: group {}, {}'.format(tutorial_group,
+                                                        seminar_group)
+            feed = gzip_page(to_ics(current.searcher.iter_matches(query),
+                                    name))
+            current.feeds[query] = feed
+        response = _gzipped_response(feed, gzipped, 'text/calendar')
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+def _stream_events(entries):
+    for entry in entries:
+        yield json.dumps(entry_to_dict(*entry), sort_keys=True) + '\n'
+
+@app.route('/api/events')
+def api_events():
+    """Return the events matching a search as newline-delimited JSON,
+    one event per line, in timetable order.  The search is given by the
+    same query string fields as /timetable, except that group, code and
+    weekday fields may be left out to match any value.  The first
+    `offset` matching events are skipped, and at most `limit` returned.
+    Events are written as they are found, without building a Timetable
+    of the results."""
+    terms, error_msgs = _parse_search(request.args, require_all=False)
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = request.args.get('limit')
+        limit = None if limit is None else int(limit)
+        if offset < 0 or (limit is not None and limit < 0):
+            raise ValueError
+    except ValueError:
+        error_msgs.append('Invalid value for offset or limit.')
+    if error_msgs:
+        return jsonify(errors=error_msgs), 400
+    current = data
+    _normalise_terms(terms, current.all_codes)
+    query = SearchQuery(**terms)
+    stop = None if limit is None else offset + limit
+    entries = islice(current.searcher.iter_matches(query), offset, stop)
+    return Response(_stream_events(entries), mimetype='application/x-ndjson')
+
+@app.route('/api/batch', methods=['POST'])
+def api_batch():
+    """Run a number of searches at once (see Timetable.filter_many).
+    The request body is a JSON object whose `queries` are objects
+    mapping SearchQuery term names to values encoded as in cache keys
+    (see SearchQuery.from_json_terms).  The response gives the number of
+    matching events for each query, and the events themselves unless
+    `events` is false.  At most MAX_BATCH_QUERIES queries may be given."""
+    body = request.get_json(force=True, silent=True)
+    try:
+        terms = body['queries']
+        if not isinstance(terms, list):
+            raise TypeError
+        if len(terms) > MAX_BATCH_QUERIES:
+            return jsonify(errors=['At most {} queries may be given.'.format(
+                MAX_BATCH_QUERIES)]), 400
+        queries = [SearchQuery.from_json_terms(d) for d in terms]
+        results = run_batch(data.searcher, queries, body.get('events', True))
+    except (TypeError, ValueError, KeyError, AttributeError):
+        return jsonify(errors=['Invalid queries.']), 400
+    return jsonify(results=results)
+
+@app.route('/admin/ingest', methods=['POST'])
+def admin_ingest():
+    """Ingest a new release of the timetable, uploaded as the JSON file
+    `timetable` (as written by parser.py).  The worker handling the
+    request is updated at once, and the merged timetable written to
+    TT_JSON_FILE; other workers pick it up when they next check the file
+    (see TT_RELOAD_INTERVAL), so with TT_RELOAD_INTERVAL set to 0 only
+    this worker is updated."""
+    _check_admin()
+    new_tt = Timetable()
+    new_tt.from_dict(json.loads(request.files['timetable'].read().decode('utf-8')))
+    diff, invalidated = ingest_release(new_tt)
+    return jsonify(changed_dates=[str(d) for d in diff.changed_dates],
+                    invalidated=invalidated)
+
+@app.route('/metrics')
+def show_metrics():
+    """Return this worker's search metrics in the Prometheus text
+    format."""
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/stats')
+def admin_stats():
+    """Return the search cache and single-flight counters of the worker
+    handling the request."""
+    _check_admin()
+    return jsonify(search_cache=search_cache.stats(),
+                    search_flight=search_flight.stats())
+
+@app.route('/admin/reload', methods=['POST'])
+def admin_reload():
+    """Reload TT_JSON_FILE now, rather than waiting for it to be
+    noticed by the periodic check."""
+    _check_admin()
+    reloaded = reload_timetable()
+    return jsonify(reloaded=reloaded, version=data.version)
+
+if TT_RELOAD_INTERVAL > 0:
+    FileWatcher(TT_JSON_FILE, reload_timetable, TT_RELOAD_INTERVAL).start()
+
+if PREWARM_CACHE:
+    threading.Thread(target=prewarm_cache, daemon=True).start()
 
 if __name__ == '__main__':
     from sys import argv
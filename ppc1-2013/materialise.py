@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+"""Precomputed timetable pages for the most common searches: those for
+one tutorial group and one seminar group, with every other term Any.
+
+Run this module as a build step, after tt.json changes:
+
+    python3 materialise.py [tt.json [materialised]] [--processes=N]
+
+It renders the page for each of the tutorial group / seminar group
+pairs, and writes each one gzip-compressed to the output directory along
+with a manifest.  The manifest records the version (Timetable.digest) of
+the timetable the pages were rendered from, so pages left over from an
+older timetable are never served.  With --processes, the pages are
+rendered by N worker processes (see parallel.py).
+"""
+
+import os
+import json
+import zlib
+from functools import partial
+
+from timetable import (Timetable, SearchQuery, all_tutorial_groups,
+                        all_seminar_groups, write_file)
+
+MANIFEST = 'manifest.json'
+
+def group_queries():
+    """Return the query for each tutorial group / seminar group pair,
+    with every other term Any."""
+    return [SearchQuery(tutorial_group=t, seminar_group=s)
+            for t in all_tutorial_groups for s in all_seminar_groups]
+
+def _page_fname(query):
+    return '{}-{}.html.gz'.format(
+        query.tutorial_group, query.seminar_group.replace(' ', '-').lower())
+
+def gzip_compressor(level=9):
+    """Return a zlib compressor object producing gzip format.  The
+    header carries no name or time, so the same page always gives the
+    same bytes."""
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+def gzip_page(html, level=9):
+    """Return the str `html`, UTF-8 encoded and gzip-compressed."""
+    compressor = gzip_compressor(level)
+    return compressor.compress(html.encode('utf-8')) + compressor.flush()
+
+def _render_page(directory, tt, query):
+    """Write the page for `query` to `directory`, and return its file
+    name."""
+    fname = _page_fname(query)
+    html = tt.filter(query).to_html()
+    write_file(os.path.join(directory, fname), gzip_page(html))
+    return fname
+
+def materialise(tt, directory, processes=1):
+    """Render the page for each of group_queries() from the timetable
+    `tt`, and write them to `directory`, using `processes` worker
+    processes if more than one.  The manifest is written last, so a
+    reader never sees a manifest naming pages not yet written."""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    queries = group_queries()
+    render = partial(_render_page, directory)
+    if processes > 1:
+        from parallel import ParallelSearcher
+        with ParallelSearcher(tt, processes) as searcher:
+            fnames = searcher.map(render, queries)
+    else:
+        fnames = [render(tt, query) for query in queries]
+    pages = {q.cache_key(): fname for q, fname in zip(queries, fnames)}
+    manifest = {'version': tt.digest(), 'pages': pages}
+    write_file(os.path.join(directory, MANIFEST),
+                json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    return len(pages)
+
+class MaterialisedPages:
+    """The precomputed pages in `directory`, if they were rendered from
+    the timetable whose digest is `version`; otherwise none."""
+
+    def __init__(self, directory, version):
+        self.directory = directory
+        self.pages = {}
+        try:
+            with open(os.path.join(directory, MANIFEST)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return
+        if manifest.get('version') == version:
+            self.pages = manifest['pages']
+
+    def __len__(self):
+        return len(self.pages)
+
+    def __contains__(self, query):
+        return query.cache_key() in self.pages
+
+    def get(self, query):
+        """Return the gzip-compressed page for `query`, or None if it
+        has not been precomputed."""
+        fname = self.pages.get(query.cache_key())
+        if fname is None:
+            return None
+        try:
+            with open(os.path.join(self.directory, fname), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+if __name__ == '__main__':
+    from sys import argv
+    args = [a for a in argv[1:] if not a.startswith('--processes=')]
+    processes = 1
+    for a in argv[1:]:
+        if a.startswith('--processes='):
+            processes = int(a.split('=', 1)[1])
+    json_fname = args[0] if len(args) > 0 else 'tt.json'
+    directory = args[1] if len(args) > 1 else 'materialised'
+    n = materialise(Timetable(json_fname), directory, processes)
+    print('Wrote {} pages to {}'.format(n, directory))
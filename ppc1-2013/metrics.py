@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+"""Lightweight counters and histograms for the app's hot paths, exposed
+in the Prometheus text format (see Registry.render).
+
+Each histogram keeps both the cumulative bucket counts Prometheus
+expects (from which it computes rates over any window) and a rolling
+window of the most recent observations, from which it reports quantiles
+directly, so that a spike shows up in /metrics without a Prometheus
+server.  The values are those of one process; with several workers,
+each reports its own.
+"""
+
+import io
+import time
+import pstats
+import cProfile
+import threading
+from bisect import bisect_left
+from collections import deque
+
+# Bucket upper bounds suited to timings, in seconds
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                0.25, 0.5, 1.0, 2.5, 5.0)
+# Number of recent observations (per set of labels) kept for quantiles
+WINDOW = 1024
+QUANTILES = (0.5, 0.95, 0.99)
+
+# The orders in which profile() can list functions
+PROFILE_SORTS = ('cumulative', 'tottime', 'calls')
+# Held while a profile is being taken, as only one profiler can be
+# active at a time (in recent Pythons, in the whole process)
+_profile_lock = threading.Lock()
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                                            .replace('"', '\\"'))
+        for name, value in pairs))
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """A count of events, optionally by the values of `labelnames`."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for labelvalues, value in values:
+            yield self.name + _labels(self.labelnames, labelvalues), value
+
+class Gauge:
+    """A value read when the metrics are rendered, from the function
+    `read`, which returns a dict mapping tuples of label values to
+    values."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, read, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.read = read
+
+    def samples(self):
+        for labelvalues, value in sorted(self.read().items()):
+            yield self.name + _labels(self.labelnames, labelvalues), value
+
+class _Series:
+    """The observations of a histogram with one set of label values."""
+
+    def __init__(self, nbuckets):
+        self.buckets = [0] * nbuckets
+        self.count = 0
+        self.sum = 0
+        self.recent = deque(maxlen=WINDOW)
+
+class Histogram:
+    """The distribution of observed values (eg, timings in seconds),
+    counted in buckets with the upper bounds `buckets`, and optionally by
+    the values of `labelnames`."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=TIME_BUCKETS, labelnames=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, value, *labelvalues):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = _Series(len(self.buckets))
+            series.buckets[i] += 1
+            series.count += 1
+            series.sum += value
+            series.recent.append(value)
+
+    def time(self, *labelvalues):
+        """Return a context manager which observes the time taken by the
+        block it manages."""
+        return _Timer(self, labelvalues)
+
+    def quantiles(self, *labelvalues):
+        """Return a dict mapping each of QUANTILES to that quantile of
+        the recent observations with `labelvalues`."""
+        with self._lock:
+            series = self._series.get(labelvalues)
+            recent = sorted(series.recent) if series is not None else []
+        if not recent:
+            return {}
+        return {q: recent[min(len(recent) - 1, int(q * len(recent)))]
+                for q in QUANTILES}
+
+    def samples(self):
+        with self._lock:
+            series = sorted((labelvalues, list(s.buckets), s.count, s.sum)
+                            for labelvalues, s in self._series.items())
+        for labelvalues, buckets, count, total in series:
+            cumulative = 0
+            for bound, n in zip(self.buckets, buckets):
+                cumulative += n
+                yield (self.name + '_bucket' + _labels(
+                    self.labelnames, labelvalues, [('le', _number(bound))]),
+                    cumulative)
+            yield self.name + '_sum' + _labels(self.labelnames, labelvalues), total
+            yield self.name + '_count' + _labels(self.labelnames, labelvalues), count
+
+    def recent_samples(self):
+        """The quantiles of the recent observations."""
+        with self._lock:
+            labelvalues = sorted(self._series)
+        for values in labelvalues:
+            for q, value in sorted(self.quantiles(*values).items()):
+                yield (self.name + '_recent' + _labels(
+                    self.labelnames, values, [('quantile', q)]), value)
+
+class _Timer:
+
+    def __init__(self, histogram, labelvalues):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start,
+                                *self.labelvalues)
+
+class Registry:
+    """A collection of metrics, rendered together."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.add(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.add(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.add(Histogram(*args, **kwargs))
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            lines.extend('{} {}'.format(name, _number(value))
+                            for name, value in metric.samples())
+            if isinstance(metric, Histogram):
+                recent = metric.name + '_recent'
+                lines.append('# HELP {} {} (the last {} observations)'.format(
+                    recent, metric.help, WINDOW))
+                lines.append('# TYPE {} gauge'.format(recent))
+                lines.extend('{} {}'.format(name, _number(value))
+                                for name, value in metric.recent_samples())
+        return '\n'.join(lines) + '\n'
+
+def profile(func, sort='cumulative', limit=40):
+    """Call func() under cProfile, and return its result and the profile
+    as text, listing the `limit` most expensive functions in the order
+    `sort` (one of PROFILE_SORTS)."""
+    if sort not in PROFILE_SORTS:
+        sort = 'cumulative'
+    profiler = cProfile.Profile()
+    with _profile_lock:
+        profiler.enable()
+        try:
+            result = func()
+        finally:
+            profiler.disable()
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats(sort).print_stats(limit)
+    return result, out.getvalue()
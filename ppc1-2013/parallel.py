@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+"""Running searches of a timetable in a pool of worker processes, for
+large batch and export jobs which would otherwise be limited to one CPU.
+
+The workers are forked after the timetable and its index have been
+loaded, so they share them copy-on-write rather than each loading its own
+copy, and nothing but query cache keys (see SearchQuery.cache_key) and
+event IDs (see EventIndex) pass between processes.  Results are put back
+together in the parent, in timetable order.
+"""
+
+import gc
+import multiprocessing
+from bisect import bisect_left
+
+from timetable import Timetable, SearchQuery
+
+# The timetable searched by the workers of the most recently created
+# pool, set before they are forked.
+_timetable = None
+
+def _fork_pool(processes):
+    """Return a Pool of `processes` processes created with fork(), which
+    is what lets them share the parent's timetable."""
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork').Pool(processes)
+    return multiprocessing.Pool(processes)
+
+def _batch_ids(keys):
+    queries = [SearchQuery.from_cache_key(k) for k in keys]
+    return _timetable.match_ids_many(queries)
+
+def _shard_ids(key, start, stop):
+    """Return the IDs, from `start` up to `stop`, of the events matching
+    the query whose cache key is `key`."""
+    sq = SearchQuery.from_cache_key(key)
+    entries = _timetable.index.entries
+    candidates = _timetable.index.candidates(sq)
+    first = bisect_left(candidates, start)
+    last = bisect_left(candidates, stop)
+    return [i for i in candidates[first:last] if sq.matches(entries[i][0])]
+
+def _apply(func, key):
+    return func(_timetable, SearchQuery.from_cache_key(key))
+
+class ParallelSearcher:
+    """Searches `timetable` using a pool of `processes` worker processes
+    (by default, one per CPU).  Batches of queries are split between the
+    workers; a single query is split by weeks, each worker searching a
+    contiguous run of weeks.  Call close() (or use a with statement) to
+    stop the workers."""
+
+    def __init__(self, timetable, processes=None):
+        global _timetable
+        self.timetable = timetable
+        self.processes = processes or multiprocessing.cpu_count()
+        # Build the index before forking, so the workers share it
+        self.entries = timetable.index.entries
+        self.shards = self._week_shards()
+        _timetable = timetable
+        if hasattr(gc, 'freeze'):
+            # Keep the collector in each worker from touching (and so
+            # copying) the pages holding the timetable.
+            gc.freeze()
+            self.pool = _fork_pool(self.processes)
+            gc.unfreeze()
+        else:
+            self.pool = _fork_pool(self.processes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def _week_shards(self):
+        """Split the event IDs into up to `processes` (start, stop) ranges
+        of roughly equal numbers of events, breaking only between weeks."""
+        week_starts = [i for i, (e, w, d) in enumerate(self.entries)
+                        if i == 0 or w is not self.entries[i - 1][1]]
+        target = len(self.entries) / self.processes
+        bounds = [0]
+        for i in week_starts[1:]:
+            if i - bounds[-1] >= target:
+                bounds.append(i)
+        bounds.append(len(self.entries))
+        return list(zip(bounds, bounds[1:]))
+
+    def _chunksize(self, n):
+        # Several chunks per worker, so that one slow chunk does not
+        # leave the others idle.
+        return max(1, -(-n // (self.processes * 4)))
+
+    def _chunks(self, items):
+        size = self._chunksize(len(items))
+        return [items[i:i+size] for i in range(0, len(items), size)]
+
+    def match_ids_many(self, queries):
+        """Return the IDs of the events matching each of `queries`, as
+        Timetable.match_ids_many does."""
+        keys = [sq.cache_key() for sq in queries]
+        results = []
+        for ids in self.pool.map(_batch_ids, self._chunks(keys)):
+            results.extend(ids)
+        return results
+
+    def filter_many(self, queries):
+        """Return a new Timetable for each of `queries`, as
+        Timetable.filter_many does."""
+        entries = self.entries
+        return [Timetable.from_entries(entries[i] for i in ids)
+                for ids in self.match_ids_many(queries)]
+
+    def match_ids(self, sq):
+        """Return the IDs of the events matching `sq`, in timetable
+        order, with each worker searching one run of weeks."""
+        key = sq.cache_key()
+        parts = self.pool.starmap(_shard_ids, [(key, start, stop)
+                                                for start, stop in self.shards])
+        return [i for part in parts for i in part]
+
+    def filter(self, sq):
+        """Return a new Timetable containing the events matching `sq`."""
+        entries = self.entries
+        return Timetable.from_entries(entries[i] for i in self.match_ids(sq))
+
+    def map(self, func, queries):
+        """Return the list of func(timetable, query) for each of
+        `queries`, called in the workers.  `func` must be picklable (eg,
+        a module-level function), as must its results."""
+        keys = [sq.cache_key() for sq in queries]
+        return self.pool.starmap(_apply, [(func, k) for k in keys],
+                                    self._chunksize(len(keys)))
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+"""Coalescing of identical computations ("single flight"), so that when
+many requests miss the cache for the same search at once, one of them
+renders the page and the rest wait for it rather than each rendering it
+too.
+
+Within a process, callers wait on the first caller's computation.
+Across processes, the first caller also takes an exclusive lock (one of
+a fixed number of byte-range locks on a shared lock file, chosen by
+hashing the key); a caller in another process which finds the lock held
+polls its `lookup` function (eg, a shared cache) until the result
+appears there or the lock is released.  The lock file needs fcntl, so
+is not used on platforms without it.  As fcntl locks belong to the
+process rather than the thread, each stripe also has a thread lock,
+held along with the byte-range lock, so that two threads of one process
+whose keys share a stripe do not both take it.
+"""
+
+import os
+import time
+import zlib
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+class _Call:
+    """A computation in progress."""
+
+    def __init__(self, key):
+        self.key = key
+        self.result = None
+        self.done = threading.Event()
+        self.locked = False
+
+class SingleFlight:
+    """Coalesces computations with the same key (a string).  A caller
+    calls begin(key, lookup), which returns (call, result):
+
+        - if `result` is not None, it is the result of another caller's
+          computation, and there is nothing more to do;
+        - otherwise, if `call` is not None, the caller must compute the
+          result and then call finish(call, result) (with None if the
+          computation failed) whatever happens;
+        - otherwise, the computation being waited for failed or took
+          longer than `timeout` seconds, and the caller should compute
+          the result itself.
+
+    If `lock_path` is given (and fcntl is available), computations are
+    also coalesced with other processes using the same lock file, as
+    long as `lookup` can see their results."""
+
+    def __init__(self, lock_path=None, timeout=30.0, stripes=256,
+                    poll_interval=0.02):
+        self.timeout = timeout
+        self.stripes = stripes
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._lock_fd = None
+        if lock_path is not None and fcntl is not None:
+            self._lock_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._stripe_locks = [threading.Lock() for i in range(stripes)]
+        # Computations run, and computations saved by waiting for one in
+        # this process or in another process.
+        self.computed = 0
+        self.shared = 0
+        self.shared_across_processes = 0
+        # Waits which ended without a result
+        self.timeouts = 0
+
+    def _stripe(self, key):
+        # Not hash(), which differs between processes
+        return zlib.crc32(key.encode('utf-8')) % self.stripes
+
+    def _try_lock(self, key):
+        stripe = self._stripe(key)
+        if not self._stripe_locks[stripe].acquire(False):
+            return False
+        try:
+            fcntl.lockf(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1,
+                        stripe)
+            return True
+        except OSError:
+            self._stripe_locks[stripe].release()
+            return False
+
+    def _unlock(self, key):
+        stripe = self._stripe(key)
+        fcntl.lockf(self._lock_fd, fcntl.LOCK_UN, 1, stripe)
+        self._stripe_locks[stripe].release()
+
+    def begin(self, key, lookup=None):
+        """Begin the computation for `key`, or wait for the one already
+        in progress; see the class docstring."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call(key)
+                leader = True
+            else:
+                leader = False
+        if not leader:
+            if call.done.wait(self.timeout) and call.result is not None:
+                with self._lock:
+                    self.shared += 1
+                return None, call.result
+            with self._lock:
+                self.timeouts += 1
+            return None, None
+        if self._lock_fd is None:
+            with self._lock:
+                self.computed += 1
+            return call, None
+        deadline = time.time() + self.timeout
+        while not self._try_lock(key):
+            result = lookup() if lookup is not None else None
+            if result is not None:
+                with self._lock:
+                    self.shared_across_processes += 1
+                self.finish(call, result)
+                return None, result
+            if time.time() > deadline:
+                with self._lock:
+                    self.timeouts += 1
+                break
+            time.sleep(self.poll_interval)
+        else:
+            call.locked = True
+            # The other process may have finished just before the lock
+            # was released to us.
+            result = lookup() if lookup is not None else None
+            if result is not None:
+                with self._lock:
+                    self.shared_across_processes += 1
+                self.finish(call, result)
+                return None, result
+        with self._lock:
+            self.computed += 1
+        return call, None
+
+    def finish(self, call, result):
+        """Record the `result` of the computation begun with `call`, and
+        wake the callers waiting for it.  Calls after the first have no
+        effect."""
+        if call.done.is_set():
+            return
+        if call.locked:
+            self._unlock(call.key)
+            call.locked = False
+        with self._lock:
+            if self._calls.get(call.key) is call:
+                del self._calls[call.key]
+        call.result = result
+        call.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': len(self._calls),
+                'computed': self.computed,
+                'shared': self.shared,
+                'shared_across_processes': self.shared_across_processes,
+                'timeouts': self.timeouts
+                }
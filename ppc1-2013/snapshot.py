@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+
+"""A compact binary snapshot format for timetables, which is much quicker
+to load than the JSON file it is compiled from.  The JSON file remains
+the editable source; run this module to compile it:
+
+    python3 snapshot.py [tt.json [tt.snap]]
+
+A snapshot consists of a header (which includes the timetable's
+digest, see Timetable.digest, and the size and modification time of the
+JSON file it was compiled from) followed by five sections:
+
+    - a string table: (n_strings + 1) uint32 offsets into a blob of
+      UTF-8 text, which follows them;
+    - week records, each pointing to a run of day records;
+    - day records, each pointing to a run of event records;
+    - event records, with times as minutes past midnight, groups as
+      bitmasks (see timetable.GroupRegistry), and text
+      fields as indices into the string table (so each distinct string
+      is stored, and loaded, once).
+
+All integers are little-endian.  The file is memory-mapped when loaded.
+
+A snapshot can also be loaded lazily (see load_snapshot_lazily), reading
+only the header and week records up front and decoding each week's days
+and events the first time they are used, so that a process which only
+searches a few weeks (eg, for today's events) starts quickly and never
+holds the rest in memory.
+"""
+
+import os
+import mmap
+import struct
+import datetime
+import threading
+
+from timetable import Timetable, Week, Day, Event, write_file
+
+MAGIC = b'PPCTTSNP'
+VERSION = 4
+
+# magic, version, n_strings, n_weeks, n_days, n_events, digest, and the
+# size and modification time (in ns) of the source JSON file
+HEADER = struct.Struct('<8sIIIII16sQq')
+OFFSET = struct.Struct('<I')
+# num, commences (ordinal), first day, number of days
+WEEK = struct.Struct('<iIII')
+# date (ordinal), first event, number of events
+DAY = struct.Struct('<III')
+# starts, ends, tutorial groups, seminar groups, flags, coordinator,
+# location, name, code
+EVENT = struct.Struct('<hhIIBIIII')
+
+NO_STRING = 0xFFFFFFFF
+NO_TIME = -1
+NO_WEEK_NUM = -1
+
+# Flags in event records
+NO_TUT_GROUPS = 1
+NO_SEM_GROUPS = 2
+
+def _time_to_minutes(t):
+    return NO_TIME if t is None else t.hour * 60 + t.minute
+
+def _source_stat(json_fname):
+    """Return the (size, modification time in ns) of the file
+    `json_fname`, as recorded in the snapshots compiled from it."""
+    st = os.stat(json_fname)
+    return st.st_size, st.st_mtime_ns
+
+def snapshot_source(fname):
+    """Return the (size, modification time in ns) of the JSON file the
+    snapshot `fname` was compiled from, or None if `fname` is missing or
+    not a snapshot in the current format."""
+    try:
+        with open(fname, 'rb') as f:
+            header = f.read(HEADER.size)
+    except OSError:
+        return None
+    if len(header) < HEADER.size:
+        return None
+    fields = HEADER.unpack(header)
+    if fields[0] != MAGIC or fields[1] != VERSION:
+        return None
+    return fields[-2:]
+
+def compile_snapshot(tt, fname, source=(0, 0)):
+    """Write the timetable `tt` to the snapshot file `fname`, recording
+    `source`, the (size, modification time in ns) of the JSON file it
+    was loaded from (see open_timetable).  The file is written
+    atomically (see timetable.write_file), so a process loading `fname`
+    never sees a partly written snapshot."""
+    strings = []
+    string_ids = {}
+    def string_id(s):
+        if s is None:
+            return NO_STRING
+        if s not in string_ids:
+            string_ids[s] = len(strings)
+            strings.append(s)
+        return string_ids[s]
+
+    weeks = []
+    days = []
+    events = []
+    for w in tt.weeks:
+        weeks.append(WEEK.pack(
+            NO_WEEK_NUM if w.num is None else w.num,
+            w.commences.toordinal() if w.commences else 0,
+            len(days), len(w.days)))
+        for d in w.days:
+            days.append(DAY.pack(d.date.toordinal(), len(events),
+                                    len(d.events)))
+            for e in d.events:
+                flags = 0
+                if e.tutorial_mask is None:
+                    flags |= NO_TUT_GROUPS
+                if e.seminar_mask is None:
+                    flags |= NO_SEM_GROUPS
+                events.append(EVENT.pack(
+                    _time_to_minutes(e.starts),
+                    _time_to_minutes(e.ends),
+                    e.tutorial_mask or 0,
+                    e.seminar_mask or 0,
+                    flags,
+                    string_id(e.coordinator),
+                    string_id(e.location),
+                    string_id(e.name),
+                    string_id(e.code)))
+
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = [0]
+    for s in encoded:
+        offsets.append(offsets[-1] + len(s))
+
+    header = HEADER.pack(MAGIC, VERSION, len(strings), len(weeks), len(days),
+                            len(events), tt.digest().encode('ascii'), *source)
+    write_file(fname, b''.join([header]
+                                + [OFFSET.pack(o) for o in offsets]
+                                + encoded + weeks + days + events))
+
+def load_snapshot(fname, tt=None):
+    """Load the snapshot file `fname` into the Timetable `tt` (or a new
+    Timetable if it is not given), and return the timetable."""
+    if tt is None:
+        tt = Timetable()
+    with open(fname, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        _load(buf, tt)
+    finally:
+        buf.close()
+    tt.build_index()
+    return tt
+
+def load_snapshot_lazily(fname):
+    """Return a LazyTimetable of the snapshot file `fname`, which is kept
+    memory-mapped until the timetable is discarded."""
+    with open(fname, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    reader = _SnapshotReader(buf)
+    tt = LazyTimetable(reader.digest)
+    for num, commences, first_day, num_days in reader.week_records():
+        tt.weeks.append(LazyWeek(reader, num, commences, first_day, num_days))
+    return tt
+
+class _SnapshotReader:
+    """Decodes the records of the snapshot in the buffer `buf`.  Strings
+    and times are decoded when first needed, and shared between all the
+    events having the same value."""
+
+    def __init__(self, buf):
+        (magic, version, n_strings, self.n_weeks, n_days, self.n_events,
+            digest) = HEADER.unpack_from(buf, 0)[:7]
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not a version {} timetable snapshot'.format(
+                VERSION))
+        self.buf = buf
+        self.digest = digest.decode('ascii')
+        pos = HEADER.size
+        self.offsets = struct.unpack_from('<{}I'.format(n_strings + 1), buf,
+                                            pos)
+        self.string_pos = pos + OFFSET.size * (n_strings + 1)
+        self.week_pos = self.string_pos + self.offsets[-1]
+        self.day_pos = self.week_pos + WEEK.size * self.n_weeks
+        self.evt_pos = self.day_pos + DAY.size * n_days
+        self.strings = {NO_STRING: None}
+        self.times = {NO_TIME: None}
+        # Held while a LazyWeek's days are being decoded
+        self.lock = threading.Lock()
+
+    def string(self, i):
+        if i not in self.strings:
+            start = self.string_pos + self.offsets[i]
+            end = self.string_pos + self.offsets[i+1]
+            self.strings[i] = self.buf[start:end].decode('utf-8')
+        return self.strings[i]
+
+    def time(self, minutes):
+        if minutes not in self.times:
+            self.times[minutes] = datetime.time(*divmod(minutes, 60))
+        return self.times[minutes]
+
+    def week_records(self):
+        """Generate (num, commences, first day, number of days) for each
+        week record."""
+        for i in range(self.n_weeks):
+            num, commences, first_day, num_days = \
+                WEEK.unpack_from(self.buf, self.week_pos + WEEK.size * i)
+            yield (None if num == NO_WEEK_NUM else num,
+                    datetime.date.fromordinal(commences) if commences else None,
+                    first_day, num_days)
+
+    def days(self, week, first_day, num_days):
+        """Return the list of `num_days` Days (with their events) of
+        `week`, starting from day record `first_day`."""
+        days = []
+        for j in range(first_day, first_day + num_days):
+            date, first_evt, num_evts = DAY.unpack_from(
+                self.buf, self.day_pos + DAY.size * j)
+            day = Day(week, date=datetime.date.fromordinal(date))
+            days.append(day)
+            for k in range(first_evt, first_evt + num_evts):
+                (starts, ends, tut_mask, sem_mask, flags, coordinator,
+                    location, name, code) = \
+                        EVENT.unpack_from(self.buf, self.evt_pos + EVENT.size * k)
+                evt = Event(week=week, day=day)
+                evt.starts = self.time(starts)
+                evt.ends = self.time(ends)
+                evt.tutorial_mask = None if flags & NO_TUT_GROUPS else tut_mask
+                evt.seminar_mask = None if flags & NO_SEM_GROUPS else sem_mask
+                evt.coordinator = self.string(coordinator)
+                evt.location = self.string(location)
+                evt.name = self.string(name)
+                evt.code = self.string(code)
+                day.events.append(evt)
+        return days
+
+    def codes(self):
+        """Return the set of the codes of all the event records, without
+        decoding anything else."""
+        ids = set()
+        for k in range(self.n_events):
+            ids.add(EVENT.unpack_from(self.buf, self.evt_pos + EVENT.size * k)[-1])
+        return {self.string(i) for i in ids}
+
+def _load(buf, tt):
+    reader = _SnapshotReader(buf)
+    for num, commences, first_day, num_days in reader.week_records():
+        week = Week(num, commences)
+        week.days.extend(reader.days(week, first_day, num_days))
+        tt.weeks.append(week)
+
+class LazyWeek(Week):
+    """A Week of a lazily loaded snapshot, whose days (and their events)
+    are decoded the first time `days` is used."""
+
+    __slots__ = ('_reader', '_first_day', '_num_days', '_days')
+
+    def __init__(self, reader, num, commences, first_day, num_days):
+        self.num = num
+        self.commences = commences
+        self._reader = reader
+        self._first_day = first_day
+        self._num_days = num_days
+        self._days = None
+
+    @property
+    def loaded(self):
+        return self._days is not None
+
+    @property
+    def days(self):
+        if self._days is None:
+            with self._reader.lock:
+                if self._days is None:
+                    self._days = self._reader.days(self, self._first_day,
+                                                    self._num_days)
+        return self._days
+
+    @days.setter
+    def days(self, days):
+        self._days = days
+
+class LazyTimetable(Timetable):
+    """A Timetable whose weeks are LazyWeeks.  Until every week has been
+    decoded, searches look only at the weeks which might match (see
+    SearchQuery.may_match_week), so searches for a date or a range of
+    dates decode only the weeks they cover; once all have been decoded,
+    the index is built and searches use it as usual."""
+
+    def __init__(self, digest):
+        super().__init__()
+        # The digest stored in the snapshot, until the timetable changes.
+        # Building the index does not change it, and ingest.apply_diff
+        # changes a copy, so only new_week() makes it stale.
+        self._digest = digest
+
+    def _all_loaded(self):
+        return all(w.loaded for w in self.weeks if isinstance(w, LazyWeek))
+
+    def new_week(self, num=None, commences=None):
+        self._digest = None
+        return super().new_week(num, commences)
+
+    def digest(self):
+        if self._digest is not None:
+            return self._digest
+        return super().digest()
+
+    def codes(self):
+        if self._index is None:
+            return self.weeks[0]._reader.codes() if self.weeks else set()
+        return super().codes()
+
+    def iter_matches(self, sq):
+        if self._index is not None or self._all_loaded():
+            return super().iter_matches(sq)
+        return self._scan_matches(sq)
+
+    def _scan_matches(self, sq):
+        for week in self.weeks:
+            if sq.may_match_week(week):
+                for day in week.days:
+                    for event in day.events:
+                        if sq.matches(event):
+                            yield event, week, day
+
+def open_timetable(json_fname, snapshot_fname, lazy=False):
+    """Return the Timetable in `json_fname`, loading it from the snapshot
+    `snapshot_fname` and (re)compiling the snapshot first if it is
+    missing, written in an older format, or was compiled from a JSON
+    file of a different size or modification time (older or newer, so
+    that a file copied into place with its original time is noticed).
+    Falls back to loading the JSON file directly if the snapshot cannot
+    be written.  If `lazy`, the snapshot is loaded lazily (see
+    load_snapshot_lazily); the JSON file is always loaded in full."""
+    # Taken before the JSON file is read, so that if it changes while
+    # being read the snapshot is recompiled next time.
+    source = _source_stat(json_fname)
+    load = load_snapshot_lazily if lazy else load_snapshot
+    if snapshot_source(snapshot_fname) == source:
+        try:
+            return load(snapshot_fname)
+        except ValueError:
+            pass
+    tt = Timetable(json_fname)
+    try:
+        compile_snapshot(tt, snapshot_fname, source)
+    except OSError:
+        return tt
+    if lazy:
+        return load_snapshot_lazily(snapshot_fname)
+    return tt
+
+if __name__ == '__main__':
+    from sys import argv
+    json_fname = argv[1] if len(argv) > 1 else 'tt.json'
+    snapshot_fname = argv[2] if len(argv) > 2 else 'tt.snap'
+    source = _source_stat(json_fname)
+    compile_snapshot(Timetable(json_fname), snapshot_fname, source)
@@ -10,59 +10,149 @@
 #                return False; return self
 # - Have SearchQuery return its state as a tuple so it can be hashed and
 #   stored in a dict (to act as a search cache)
-# - Maybe drop xml.dom when building html
 
+import os
 import re
+import sys
 import datetime
 import time
 import json
-import xml.dom
+import hashlib
+import threading
+from operator import attrgetter
+from html import escape
+from bisect import bisect_left, bisect_right
 
 EmptyValue = object()
 
 one_day = datetime.timedelta(1)
 
-def _get_boldtext(doc, text):
-    b = doc.createElement('b')
-    text = doc.createTextNode(text)
-    b.appendChild(text)
-    return b
+# Values repeated across many events (times, and strings such as
+# coordinators, locations and codes) are shared rather than each event
+# holding its own copy.
+_times = {}
 
-def _add_td(doc, row, content, colspan=1, bold=False):
-    """Create a td element containing `content` and add it to `row`,
-    which is part of `doc`"""
-    #print(type(text))
+def write_file(fname, data):
+    """Write the bytes `data` to `fname` under a temporary name and then
+    rename it, so that no process reading `fname` sees a partly written
+    file."""
+    tmp_fname = '{}.{}.{}.tmp'.format(fname, os.getpid(),
+                                        threading.get_ident())
+    try:
+        with open(tmp_fname, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_fname, fname)
+    except:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+        raise
+
+def _parse_time(s):
+    """Return the (shared) datetime.time for the 'HH:MM' string `s`."""
+    t = _times.get(s)
+    if t is None:
+        t = datetime.time(*(int(i) for i in s.split(':')))
+        _times[s] = t
+    return t
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+def _td(content, colspan=1, bold=False):
+    """Return a td element containing the text `content`."""
     if content is None:
         content = 'n/a'
-    col = doc.createElement('td colspan={}'.format(colspan))
-    if not isinstance(content, xml.dom.Node):
-        text = doc.createTextNode(content)
-        if bold:
-            content = doc.createElement('b')
-            content.appendChild(text)
-        else:
-            content = text
-    col.appendChild(content)
-    row.appendChild(col)
-
-def _get_dropdown(doc, values):
-    dropdown = doc.createElement('select')
-    for v in values:
-        opt = doc.createElement('option')
-        opttext = doc.createTextNode(str(v))
-        opt.appendChild(opttext)
-        dropdown.appendChild(opt)
-    return dropdown
+    content = escape(str(content))
+    if bold:
+        content = '<b>{}</b>'.format(content)
+    return '<td colspan="{}">{}</td>'.format(colspan, content)
+
+def _get_dropdown(values):
+    """Return a td element containing a select element with an option
+    for each of `values`."""
+    if values is None:
+        return _td(None)
+    options = ''.join('<option>{}</option>'.format(escape(str(v)))
+                        for v in values)
+    return '<td colspan="1"><select>{}</select></td>'.format(options)
     
 all_tutorial_groups = list(range(1, 21))
 all_seminar_groups = ['{} {}'.format(color, letter)
-                        for letter in 'ABCDEFGHKLMNOPQR'
-                        for color in ['Red', 'Blue']]
+                        for color in ['Red', 'Blue']
+                        for letter in 'ABCDEFGHKLMNOPQR']
+
+class GroupRegistry:
+    """Assigns each of a fixed list of groups its own bit, so that a
+    set of groups can be stored as an integer bitmask and membership
+    tested with a bitwise AND."""
+    
+    def __init__(self, groups):
+        self.groups = tuple(groups)
+        self._bits = {g: 1 << i for i, g in enumerate(self.groups)}
+        self.all_mask = (1 << len(self.groups)) - 1
+        # Decoded lists are shared between all masks of the same value
+        self._lists = {}
+    
+    def __iter__(self):
+        return iter(self.groups)
+    
+    def __len__(self):
+        return len(self.groups)
+    
+    def __contains__(self, group):
+        return group in self._bits
+    
+    def bit(self, group):
+        """Return the bit for `group`, or 0 if it is not registered."""
+        return self._bits.get(group, 0)
+    
+    def to_mask(self, groups):
+        """Return the bitmask for the iterable `groups`."""
+        mask = 0
+        for g in groups:
+            try:
+                mask |= self._bits[g]
+            except KeyError:
+                raise ValueError('Unknown group: {!r}'.format(g))
+        return mask
+    
+    def to_groups(self, mask):
+        """Return the list of groups in `mask`, in registry order.  The
+        list returned is shared, and so must not be modified."""
+        groups = self._lists.get(mask)
+        if groups is None:
+            groups = [g for g in self.groups if mask & self._bits[g]]
+            self._lists[mask] = groups
+        return groups
+
+tutorial_group_registry = GroupRegistry(all_tutorial_groups)
+seminar_group_registry = GroupRegistry(all_seminar_groups)
+
+def _mask_from_groups(registry, groups):
+    """Convert a list of groups to a bitmask, passing through None and
+    EmptyValue (meaning no groups and unset, respectively)."""
+    if groups is None or groups is EmptyValue:
+        return groups
+    return registry.to_mask(groups)
+
+def _groups_from_mask(registry, mask):
+    if mask is None or mask is EmptyValue:
+        return mask
+    return registry.to_groups(mask)
+
+def entry_to_dict(event, week, day):
+    """Return the event of the (event, week, day) tuple as a dict, as
+    Event.to_dict does, with its date and week number added."""
+    d = event.to_dict()
+    d['date'] = day.date.isoformat()
+    d['week'] = week.num
+    return d
 
 class Timetable:
     
     def __init__(self, fname=None):
         self.weeks = []
+        self._index = None
         if fname is not None:
             with open(fname) as f:
                 d = json.load(f)
@@ -71,11 +161,18 @@ class Timetable:
     def new_week(self, num=None, commences=None):
         w = Week(num, commences)
         self.weeks.append(w)
+        self._index = None
         return w
     
     def is_sane(self):
         return len(self.weeks) == 30 and all(map(lambda w:w.is_sane(), self.weeks))
     
+    def save(self, fname):
+        """Write this timetable to the JSON file `fname` (see
+        write_file)."""
+        text = json.dumps(self.to_dict(), indent=2, separators=(', ', ': '))
+        write_file(fname, text.encode('utf-8'))
+    
     def to_dict(self):
         d = {'type': 'timetable'}
         d['weeks'] = []
@@ -83,55 +180,300 @@ class Timetable:
             d['weeks'].append(week.to_dict())
         return d
     
+    def digest(self):
+        """Return a short hex digest of the contents of this timetable,
+        which changes whenever any of its events do."""
+        text = json.dumps(self.to_dict(), sort_keys=True)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+    
     def from_dict(self, d):
         assert d['type'] == 'timetable'
         for w in d['weeks']:
             week = Week()
             week.from_dict(w)
             self.weeks.append(week)
+        self.build_index()
     
-    def to_html(self):
-        dom = xml.dom.getDOMImplementation()
-        doc = dom.createDocument(None, None, None)
-        html = doc.createElement('html')
-        head = doc.createElement('head')
-        title = doc.createElement('title')
-        title_text = doc.createTextNode('PPC1 2013 timetable')
-        title.appendChild(title_text)
-        head.appendChild(title)
-        html.appendChild(head)
-        body = doc.createElement('body')
-        table = doc.createElement('table border=1')
-        head_row = doc.createElement('tr')
-        _add_td(doc, head_row, 'Time', bold=True)
-        _add_td(doc, head_row, 'Code', bold=True)
-        _add_td(doc, head_row, 'Name', bold=True)
-        _add_td(doc, head_row, 'Coordinator', bold=True)
-        _add_td(doc, head_row, 'Location', bold=True)
-        _add_td(doc, head_row, 'Tutorial groups (click to see all)',
-                bold=True)
-        _add_td(doc, head_row, 'Skills groups (click to see all)',
-                bold=True)
-        table.appendChild(head_row)
+    def iter_html(self):
+        """Generate the HTML for this timetable as a series of string
+        chunks (one per week), so that it can be streamed to the client
+        without first building the whole page."""
+        yield ('<html>\n<head><title>PPC1 2013 timetable</title></head>\n'
+                '<body>\n<table border="1">\n')
+        yield '<tr>{}</tr>\n'.format(''.join([
+            _td('Time', bold=True),
+            _td('Code', bold=True),
+            _td('Name', bold=True),
+            _td('Coordinator', bold=True),
+            _td('Location', bold=True),
+            _td('Tutorial groups (click to see all)', bold=True),
+            _td('Skills groups (click to see all)', bold=True)
+            ]))
         for w in self.weeks:
-            for r in w.to_html(doc):
-                table.appendChild(r)
-        body.appendChild(table)
-        html.appendChild(body)
-        doc.appendChild(html)
-        return doc.toprettyxml()
+            yield w.to_html()
+        yield '</table>\n</body>\n</html>\n'
+    
+    def to_html(self):
+        return ''.join(self.iter_html())
         
+    def build_index(self):
+        self._index = EventIndex(self)
+    
+    @property
+    def index(self):
+        """The EventIndex for this timetable, built on first use if the
+        timetable was not loaded from a dict."""
+        if self._index is None:
+            self.build_index()
+        return self._index
+    
+    def iter_matches(self, sq):
+        """Generate the (event, week, day) entries (see EventIndex) of
+        the events which match `sq`, in timetable order.  Candidate
+        events are found by intersecting the index postings for each
+        constrained term; the remaining terms (time and date ranges,
+        etc) are then checked against each candidate only."""
+        entries = self.index.entries
+        return (entries[evt_id] for evt_id in self.index.candidates(sq)
+                if sq.matches(entries[evt_id][0]))
+    
     def filter(self, sq):
-        new_tt = Timetable()
-        for w in self.weeks:
-            new_week = w.filter(sq)
-            if new_week.days:
+        """Return a new Timetable containing only those events which
+        match `sq`."""
+        return Timetable.from_entries(self.iter_matches(sq))
+    
+    def match_ids_many(self, queries):
+        """Return a list of the IDs (see EventIndex) of the events which
+        match each of `queries`, in timetable order.  Queries which
+        differ only in their group terms share the rest of their work:
+        the candidates for their other terms are found and checked once,
+        and each query's groups are then checked against the events
+        which pass.  So a query per tutorial group for the same week
+        walks that week's events once, not once per group."""
+        entries = self.index.entries
+        shared = {}
+        for i, sq in enumerate(queries):
+            shared.setdefault(sq.without_groups(), []).append(i)
+        results = [[] for sq in queries]
+        for common, members in shared.items():
+            # The group masks of each query (None for Any) and its results
+            members = [(queries[i]._tutorial_mask, queries[i]._seminar_mask,
+                        results[i]) for i in members]
+            for evt_id in self.index.candidates(common):
+                event = entries[evt_id][0]
+                # Events with no groups have already been ruled out by
+                # common's (Any) group checks.
+                if common.matches(event):
+                    tut_mask = event.tutorial_mask
+                    sem_mask = event.seminar_mask
+                    for tut, sem, matched in members:
+                        if ((tut is None or tut & tut_mask)
+                                and (sem is None or sem & sem_mask)):
+                            matched.append(evt_id)
+        return results
+    
+    def filter_many(self, queries):
+        """Return a list of new Timetables, one for each of `queries`,
+        containing the events which match it (as filter() would), found
+        with match_ids_many()."""
+        entries = self.index.entries
+        return [Timetable.from_entries(entries[i] for i in ids)
+                for ids in self.match_ids_many(queries)]
+    
+    def codes(self):
+        """Return the set of the codes of the events in this timetable
+        (including None, for days off)."""
+        return set(self.index.values('code'))
+    
+    def iter_entries(self):
+        """Generate an (event, week, day) tuple for each event in this
+        timetable, in order."""
+        for week in self.weeks:
+            for day in week.days:
+                for event in day.events:
+                    yield event, week, day
+    
+    @classmethod
+    def from_entries(cls, entries):
+        """Return a new Timetable containing the events in `entries`, an
+        iterable of (event, week, day) tuples in timetable order (see
+        EventIndex), laid out in new Weeks and Days like those they
+        came from.  Weeks and days with no events are left out."""
+        new_tt = cls()
+        last_week = last_day = None
+        for event, week, day in entries:
+            if week is not last_week:
+                new_week = Week(week.num, week.commences)
                 new_tt.weeks.append(new_week)
+                last_week = week
+                last_day = None
+            if day is not last_day:
+                new_day = Day(week, date=day.date)
+                new_week.days.append(new_day)
+                last_day = day
+            new_day.events.append(event)
         return new_tt
 
+def _union_sorted(postings):
+    """Merge a number of sorted lists of event IDs into one sorted list
+    without duplicates."""
+    if len(postings) == 1:
+        return postings[0]
+    return sorted(set().union(*postings))
+
+def _intersect_sorted(postings):
+    """Intersect a number of sorted lists of event IDs, starting with
+    the shortest and bisecting into each of the longer ones."""
+    postings = sorted(postings, key=len)
+    result = postings[0]
+    for other in postings[1:]:
+        if not result:
+            break
+        matched = []
+        lo = 0
+        hi = len(other)
+        for evt_id in result:
+            lo = bisect_left(other, evt_id, lo, hi)
+            if lo == hi:
+                break
+            if other[lo] == evt_id:
+                matched.append(evt_id)
+        result = matched
+    return result
+
+class _RangeIndex:
+    """Event IDs sorted by a key (a date or time), so that the IDs of the
+    events whose key lies within a range can be found by bisection."""
+    
+    def __init__(self, pairs):
+        pairs = sorted(pairs)
+        self.keys = [key for key, evt_id in pairs]
+        self.ids = [evt_id for key, evt_id in pairs]
+    
+    def between(self, start, end):
+        """Return the sorted IDs of the events with keys in the closed
+        range `start` to `end`."""
+        lo = bisect_left(self.keys, start)
+        hi = bisect_right(self.keys, end, lo)
+        return sorted(self.ids[lo:hi])
+
+class EventIndex:
+    """An inverted index over the events in a Timetable, mapping the
+    value of each indexed search term to a sorted list ("posting") of
+    the IDs of the events having that value.  Events are also indexed
+    by date, start time and end time in sorted order, so that date and
+    time range terms can be answered by bisection.
+    
+    Event IDs are assigned in the order in which events appear in the
+    timetable, so iterating over a posting visits events in week and
+    day order."""
+    
+    # SearchQuery attributes which are indexed.  Any other term is left
+    # to be checked by SearchQuery.matches against each candidate.
+    fields = (
+        'tutorial_group',
+        'seminar_group',
+        'code',
+        'day_of_week',
+        'week_num',
+        'month',
+        'date'
+        )
+    range_fields = (
+        'daterange',
+        'timerange'
+        )
+    
+    def __init__(self, timetable):
+        # Each entry is an (event, week, day) tuple, the event ID being
+        # its position in this list.
+        self.entries = []
+        self.postings = {f: {} for f in self.fields}
+        for w in timetable.weeks:
+            for d in w.days:
+                for e in d.events:
+                    self._add(e, w, d)
+        self.by_date = _RangeIndex(
+            (d.date, i) for i, (e, w, d) in enumerate(self.entries)
+            if d.date is not None)
+        self.by_start = _RangeIndex(
+            (e.starts, i) for i, (e, w, d) in enumerate(self.entries)
+            if isinstance(e.starts, datetime.time))
+        self.by_end = _RangeIndex(
+            (e.ends, i) for i, (e, w, d) in enumerate(self.entries)
+            if isinstance(e.ends, datetime.time))
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def _post(self, field, value, evt_id):
+        self.postings[field].setdefault(value, []).append(evt_id)
+    
+    def _add(self, event, week, day):
+        evt_id = len(self.entries)
+        self.entries.append((event, week, day))
+        for group in event.tutorial_groups or ():
+            self._post('tutorial_group', group, evt_id)
+        for group in event.seminar_groups or ():
+            self._post('seminar_group', group, evt_id)
+        self._post('code', event.code, evt_id)
+        self._post('week_num', week.num, evt_id)
+        if day.date is not None:
+            self._post('date', day.date, evt_id)
+            self._post('day_of_week', day.date.weekday(), evt_id)
+            self._post('month', day.date.month, evt_id)
+    
+    def values(self, field):
+        """Return the distinct values indexed for `field`."""
+        return self.postings[field].keys()
+    
+    def lookup(self, field, term):
+        """Return the sorted posting for `term` in `field`, or None if
+        the term cannot be answered from the index."""
+        postings = self.postings[field]
+        if term is Any or isinstance(term, TimeRange):
+            return None
+        elif isinstance(term, MultiSearchTerm):
+            return _union_sorted([postings.get(v, []) for v in term])
+        else:
+            return postings.get(term, [])
+    
+    def range_lookup(self, field, term):
+        """Return the sorted IDs of the events within the range `term`
+        for `field` ('daterange' or 'timerange'), or None if the term
+        cannot be answered from the index.  As in SearchQuery.matches,
+        an event is within a time range if it starts or ends in it."""
+        if not isinstance(term, TimeRange):
+            return None
+        if field == 'daterange':
+            return self.by_date.between(term.start, term.end)
+        else:
+            return _union_sorted([
+                self.by_start.between(term.start, term.end),
+                self.by_end.between(term.start, term.end)
+                ])
+    
+    def candidates(self, sq):
+        """Return the sorted IDs of the events which might match `sq`,
+        according to its indexed terms."""
+        found = []
+        for field in self.fields:
+            posting = self.lookup(field, getattr(sq, field))
+            if posting is not None:
+                found.append(posting)
+        for field in self.range_fields:
+            posting = self.range_lookup(field, getattr(sq, field))
+            if posting is not None:
+                found.append(posting)
+        if not found:
+            return range(len(self.entries))
+        return _intersect_sorted(found)
+
 class Week:
     """A work week, ie Mon-Fri."""
     
+    __slots__ = ('num', 'commences', 'days')
+    
     def __init__(self, num=None, commences=None):
         self.num = num
         self.commences = commences
@@ -177,15 +519,11 @@ class Week:
             day.from_dict(dd, self)
             self.days.append(day)
     
-    def to_html(self, doc):
-        rows = []
-        title_row = doc.createElement('tr')
-        _add_td(doc, title_row, str(self), 7, bold=True)
-        rows.append(title_row)
+    def to_html(self):
+        rows = ['<tr>{}</tr>\n'.format(_td(str(self), 7, bold=True))]
         for d in self.days:
-            for r in d.to_html(doc):
-                rows.append(r)
-        return rows
+            rows.append(d.to_html())
+        return ''.join(rows)
     
     def filter(self, sq):
         new_week = Week(self.num, self.commences)
@@ -198,6 +536,8 @@ class Week:
 
 class Day:
     
+    __slots__ = ('week', 'date', 'day_of_week', 'events')
+    
     days_of_week = [
         'Monday',
         'Tuesday',
@@ -254,14 +594,11 @@ class Day:
             evt.from_dict(e)
             self.events.append(evt)
     
-    def to_html(self, doc):
-        rows = []
-        title_row = doc.createElement('tr')
-        _add_td(doc, title_row, str(self), 7, bold=True)
-        rows.append(title_row)
+    def to_html(self):
+        rows = ['<tr>{}</tr>\n'.format(_td(str(self), 7, bold=True))]
         for e in self.events:
-            rows.append(e.to_html(doc))
-        return rows
+            rows.append(e.to_html())
+        return ''.join(rows)
     
     def filter(self, sq):
         new_day = Day(self.week, date=self.date)
@@ -272,6 +609,9 @@ class Day:
 
 class Event:
     
+    __slots__ = ('starts', 'ends', 'tutorial_mask', 'seminar_mask',
+                    'coordinator', 'location', 'name', 'code', 'day', 'week')
+    
     def __init__(self, week=EmptyValue, day=EmptyValue):
         
         self.starts = EmptyValue
@@ -285,13 +625,34 @@ class Event:
         self.day = day
         self.week = week
     
+    # Group membership is stored as bitmasks (see GroupRegistry); the
+    # tutorial_groups and seminar_groups properties present them as
+    # lists of groups.
+    
+    @property
+    def tutorial_groups(self):
+        return _groups_from_mask(tutorial_group_registry, self.tutorial_mask)
+    
+    @tutorial_groups.setter
+    def tutorial_groups(self, groups):
+        self.tutorial_mask = _mask_from_groups(tutorial_group_registry, groups)
+    
+    @property
+    def seminar_groups(self):
+        return _groups_from_mask(seminar_group_registry, self.seminar_mask)
+    
+    @seminar_groups.setter
+    def seminar_groups(self, groups):
+        self.seminar_mask = _mask_from_groups(seminar_group_registry, groups)
+    
     def is_sane(self):
         sane = not EmptyValue in [self.starts, self.ends,
             self.tutorial_groups, self.seminar_groups,
             self.coordinator, self.location, self.name, self.code,
             self.day, self.week]
         if not sane:
-            print('NOT SANE', self.day, self.__dict__)
+            print('NOT SANE', self.day,
+                    {a: getattr(self, a) for a in Event.__slots__})
         return sane
     
     def to_dict(self):
@@ -309,23 +670,22 @@ class Event:
     def from_dict(self, d):
         assert d['type'] == 'event'
         if d['starts'] is not None:
-            self.starts = datetime.time(*(int(i) for i in d['starts'].split(':')))
+            self.starts = _parse_time(d['starts'])
         else:
             self.starts = None
         if d['ends'] is not None:
-            self.ends = datetime.time(*(int(i) for i in d['ends'].split(':')))
+            self.ends = _parse_time(d['ends'])
         else:
             self.ends = None
         self.tutorial_groups = d['tutorial_groups']
         self.seminar_groups = d['seminar_groups']
-        self.coordinator = d['coordinator']
-        self.location = d['location']
-        self.code = d['code']
-        self.name = d['name']
+        self.coordinator = _intern(d['coordinator'])
+        self.location = _intern(d['location'])
+        self.code = _intern(d['code'])
+        self.name = _intern(d['name'])
     
     
-    def to_html(self, doc):
-        row = doc.createElement('tr')
+    def to_html(self):
         if self.starts and self.ends:
             time = '-'.join([
                 self.starts.strftime('%H:%M'),
@@ -335,18 +695,21 @@ class Event:
             time = self.starts.strftime('%H:%M')
         else:
             time = 'n/a'
-        _add_td(doc, row, time)
-        _add_td(doc, row, self.code)
-        _add_td(doc, row, self.name)
-        _add_td(doc, row, self.coordinator)
-        _add_td(doc, row, self.location)
-        _add_td(doc, row, _get_dropdown(doc, self.tutorial_groups))
-        _add_td(doc, row, _get_dropdown(doc, self.seminar_groups))
-        return row
+        return '<tr>{}</tr>\n'.format(''.join([
+            _td(time),
+            _td(self.code),
+            _td(self.name),
+            _td(self.coordinator),
+            _td(self.location),
+            _get_dropdown(self.tutorial_groups),
+            _get_dropdown(self.seminar_groups)
+            ]))
         
 
 class DayOffEvent(Event):
     
+    __slots__ = ()
+    
     def __init__(self, week=EmptyValue, day=EmptyValue):
         
         self.starts = None
@@ -402,7 +765,129 @@ class TimeRange:
     def __eq__(self, other):
         return (self.start == other.start) and (self.end == other.end)
 
+def _term_key(term):
+    """Convert a SearchQuery term to a JSON-serialisable value.  Values
+    other than strings, numbers and None (including Any) are encoded as
+    lists whose first item names their type."""
+    if term is Any:
+        return ['any']
+    elif isinstance(term, MultiSearchTerm):
+        # Order of values is irrelevant to what a MultiSearchTerm
+        # matches, so sort them to get a canonical key.
+        values = [_term_key(v) for v in term]
+        values.sort(key=lambda v: json.dumps(v, sort_keys=True))
+        return ['any_of'] + values
+    elif isinstance(term, TimeRange):
+        return ['range', _term_key(term.start), _term_key(term.end)]
+    elif isinstance(term, datetime.date):
+        return ['date', term.isoformat()]
+    elif isinstance(term, datetime.time):
+        return ['time', term.isoformat()]
+    else:
+        return term
+
+def _term_from_key(key):
+    """Reverse _term_key.  Raise ValueError if `key` is not a value which
+    _term_key could have returned."""
+    if isinstance(key, list):
+        kind = key[0] if key else None
+        if kind == 'any' and len(key) == 1:
+            return Any
+        elif kind == 'any_of':
+            values = [_term_from_key(v) for v in key[1:]]
+            if any(v is Any or isinstance(v, (MultiSearchTerm, TimeRange))
+                    for v in values):
+                raise ValueError('Invalid search term: {!r}'.format(key))
+            return MultiSearchTerm(*values)
+        elif kind == 'range' and len(key) == 3:
+            start = _term_from_key(key[1])
+            end = _term_from_key(key[2])
+            if (type(start) is type(end)
+                    and type(start) in (datetime.date, datetime.time)):
+                return TimeRange(start, end)
+        elif (kind in ('date', 'time') and len(key) == 2
+                and isinstance(key[1], str)):
+            cls, sep = ((datetime.date, '-') if kind == 'date'
+                        else (datetime.time, ':'))
+            try:
+                return cls(*(int(i) for i in key[1].split(sep)))
+            except TypeError:
+                pass
+        raise ValueError('Invalid search term: {!r}'.format(key))
+    elif isinstance(key, dict):
+        raise ValueError('Invalid search term: {!r}'.format(key))
+    return key
+
+def _equality_check(term, get):
+    """Return a function checking that the value returned by `get` for
+    an event equals `term` (any of its values, for a MultiSearchTerm)."""
+    if isinstance(term, MultiSearchTerm):
+        values = frozenset(term)
+        return lambda e: get(e) in values
+    return lambda e: term == get(e)
+
+def _range_check(term, *getters):
+    """Return a function checking that any of the values returned by
+    `getters` for an event is within the range `term`."""
+    if isinstance(term, TimeRange):
+        start, end = term
+        def check(e):
+            for get in getters:
+                v = get(e)
+                if v is not None and start <= v <= end:
+                    return True
+            return False
+        return check
+    return lambda e: any(get(e) in term for get in getters)
+
+def _group_check(mask, attr):
+    get = attrgetter(attr)
+    if mask is None:
+        return lambda e: get(e) is not None
+    return lambda e: get(e) is not None and bool(get(e) & mask)
+
 class SearchQuery:
+    """A set of terms against which events can be matched.  Each term
+    is either Any, a single value, a MultiSearchTerm or (for daterange
+    and timerange) a TimeRange.
+    
+    When a query is created, its constrained terms are compiled into a
+    list of checks, so a query's terms should not be changed after it is
+    created."""
+    
+    # Attributes whose values are compared for equality with an event's,
+    # and how to get the event's value.
+    _event_values = {
+        'starts': attrgetter('starts'),
+        'ends': attrgetter('ends'),
+        'coordinator': attrgetter('coordinator'),
+        'location': attrgetter('location'),
+        'name': attrgetter('name'),
+        'code': attrgetter('code'),
+        'date': attrgetter('day.date'),
+        'day_of_week': lambda e: e.day.date.weekday(),
+        'week_num': attrgetter('week.num'),
+        'month': attrgetter('day.date.month')
+        }
+    
+    # The order in which terms are checked by matches(): those which
+    # typically rule out the most events come first.
+    _check_order = (
+        'date',
+        'week_num',
+        'daterange',
+        'month',
+        'starts',
+        'ends',
+        'name',
+        'location',
+        'coordinator',
+        'code',
+        'day_of_week',
+        'timerange',
+        'tutorial_group',
+        'seminar_group'
+        )
     
     def __init__(self, starts=Any, ends=Any, tutorial_group=Any,
         seminar_group=Any, coordinator=Any, location=Any, name=Any,
@@ -423,6 +908,11 @@ class SearchQuery:
         self.month = month
         self.daterange = daterange
         self.timerange = timerange
+        self._tutorial_mask = self._group_mask(tutorial_group_registry,
+                                                tutorial_group)
+        self._seminar_mask = self._group_mask(seminar_group_registry,
+                                                seminar_group)
+        self._checks = self._compile()
     
     def __iter__(self):
         return iter((
@@ -448,40 +938,125 @@ class SearchQuery:
     def __eq__(self, other):
         return tuple(self) == tuple(other)
     
-    def _groups_match(self, group, evt_groups):
-        #print(group, evt_groups)
-        if evt_groups is None:
+    def cache_key(self):
+        """Return a string identifying this query which, unlike the
+        value of hash(), is the same in every process, so it can be used
+        as the key of a cache shared between processes."""
+        return json.dumps([_term_key(t) for t in self],
+                            separators=(',', ':'))
+    
+    # The SearchQuery arguments corresponding to the terms returned by
+    # __iter__, in order.
+    _term_names = (
+        'tutorial_group',
+        'seminar_group',
+        'starts',
+        'ends',
+        'coordinator',
+        'location',
+        'name',
+        'code',
+        'date',
+        'day_of_week',
+        'week_num',
+        'month',
+        'daterange',
+        'timerange'
+        )
+    
+    @classmethod
+    def from_cache_key(cls, key):
+        """Return the SearchQuery whose cache_key() is `key`."""
+        terms = json.loads(key)
+        return cls(**{name: _term_from_key(t)
+                        for name, t in zip(cls._term_names, terms)})
+    
+    @classmethod
+    def from_json_terms(cls, d):
+        """Return the SearchQuery with the terms in the dict `d`, which
+        maps term names to values encoded as in cache_key() (eg,
+        {"tutorial_group": 3, "week_num": ["any_of", 11, 12]}).  Terms
+        not in `d` (or given as ["any"]) are Any.  Raise ValueError (or TypeError, for unknown
+        term names) if `d` does not give a valid query."""
+        terms = {name: _term_from_key(t) for name, t in d.items()}
+        for name, bound_type in (('daterange', datetime.date),
+                                    ('timerange', datetime.time)):
+            term = terms.get(name, Any)
+            if term is not Any and not (isinstance(term, TimeRange)
+                                        and type(term.start) is bound_type):
+                raise ValueError('Invalid {}: {!r}'.format(name, d[name]))
+        return cls(**terms)
+    
+    def may_match_week(self, week):
+        """Return whether any event in `week` might match this query,
+        judging only by the week's number and the dates it covers (from
+        its commencement date to six days later), so that weeks which
+        cannot match need not be searched."""
+        if self.week_num is not Any and not self.week_num == week.num:
             return False
-        elif group is Any:
+        if week.commences is None:
             return True
+        dates = [week.commences + one_day * i for i in range(7)]
+        if self.date is not Any and not any(self.date == d for d in dates):
+            return False
+        if self.month is not Any and not any(self.month == d.month
+                                                for d in dates):
+            return False
+        if self.daterange is not Any and not any(d in self.daterange
+                                                    for d in dates):
+            return False
+        return True
+    
+    def without_groups(self):
+        """Return a copy of this query with Any for its group terms."""
+        terms = dict(zip(self._term_names, self))
+        terms['tutorial_group'] = terms['seminar_group'] = Any
+        return SearchQuery(**terms)
+    
+    @staticmethod
+    def _group_mask(registry, group):
+        """Return the bitmask of the groups matched by the term `group`,
+        or None if it matches any group."""
+        if group is Any:
+            return None
+        elif isinstance(group, MultiSearchTerm):
+            mask = 0
+            for g in group:
+                mask |= registry.bit(g)
+            return mask
         else:
-            return group in evt_groups
-    
-    def matches_groups(self, event):
-        return all([
-            self._groups_match(self.tutorial_group, event.tutorial_groups),
-            self._groups_match(self.seminar_group, event.seminar_groups)
-            ])
-    
-    def matches_info(self, event):
-        return all([
-            self.starts == event.starts,
-            self.ends == event.ends,
-            self.coordinator == event.coordinator,
-            self.location == event.location,
-            self.name == event.name,
-            self.code == event.code,
-            self.date == event.day.date,
-            self.day_of_week == event.day.date.weekday(),
-            self.week_num == event.week.num,
-            self.month == event.day.date.month,
-            event.day.date in self.daterange,
-            (event.starts in self.timerange) or (event.ends in self.timerange)
-            ])
+            return registry.bit(group)
+    
+    def _compile(self):
+        """Return a list of functions which an event must all satisfy to
+        match this query, leaving out terms which match anything."""
+        checks = []
+        for attr in self._check_order:
+            term = getattr(self, attr)
+            if attr == 'tutorial_group':
+                # Group checks are always needed, as they also rule out
+                # events with no groups (days off).
+                checks.append(_group_check(self._tutorial_mask,
+                                            'tutorial_mask'))
+            elif attr == 'seminar_group':
+                checks.append(_group_check(self._seminar_mask,
+                                            'seminar_mask'))
+            elif term is Any:
+                continue
+            elif attr == 'daterange':
+                checks.append(_range_check(term, attrgetter('day.date')))
+            elif attr == 'timerange':
+                checks.append(_range_check(term, attrgetter('starts'),
+                                            attrgetter('ends')))
+            else:
+                checks.append(_equality_check(term, self._event_values[attr]))
+        return checks
     
     def matches(self, event):
-        #print(self.matches_groups(event), self.matches_info(event))
-        return self.matches_groups(event) and self.matches_info(event)
+        for check in self._checks:
+            if not check(event):
+                return False
+        return True
     
 class MultiSearchTerm:
     """Provided as a term to a SearchQuery, and matches against a number
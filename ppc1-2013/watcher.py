@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+"""Polls a data file for changes, so that a running server can reload it
+without being restarted."""
+
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class FileWatcher:
+    """Calls `on_change` whenever the modification time or size of the
+    file `fname` changes.  start() polls the file every `interval`
+    seconds in a background thread; check() polls it once."""
+
+    def __init__(self, fname, on_change, interval=5.0):
+        self.fname = fname
+        self.on_change = on_change
+        self.interval = interval
+        self._stamp = self._current_stamp()
+
+    def _current_stamp(self):
+        try:
+            st = os.stat(self.fname)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def check(self):
+        """Call on_change if the file has changed since it was last
+        checked, and return whether it had.  A file which has gone
+        missing is not treated as changed.  If on_change raises, the
+        change is seen again by the next check."""
+        stamp = self._current_stamp()
+        if stamp is None or stamp == self._stamp:
+            return False
+        self.on_change()
+        self._stamp = stamp
+        return True
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except Exception:
+                # The old data stays in use until the file can be
+                # loaded (eg, once it has been completely written).
+                logger.exception('Reloading %s failed', self.fname)
+
+    def start(self):
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+        return thread